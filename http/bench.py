@@ -0,0 +1,188 @@
+# Load generator for server.py
+# Usage: python bench.py [host] [port] [connections] [seconds] [label]
+# Opens the given number of keep-alive connections (one thread each), sends a mix of static files, redirects and
+# /calculate-x questions for the given time, then prints requests/sec, latency percentiles and error rates.
+# Every run is appended as one json line to RESULTS_FILE, label it with the serving mode to compare runs
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+HOST = "127.0.0.1"
+PORT = 80
+CONNECTIONS = 32  # concurrent connections, one thread each
+DURATION = 10  # in seconds
+TIMEOUT = 5  # in seconds, a response slower than this counts as an error
+RECV_SIZE = 65536
+RESULTS_FILE = "bench_results.jsonl"  # one json object per run
+
+# request mix - kind -> (weight, list of paths, picked at random)
+MIX = {
+    "static": (60, ["/", "/avi.html", "/css/doremon.css", "/js/jquery.min.js", "/js/submit.js", "/imgs/blue.png",
+                    "/imgs/abstract.jpg"]),
+    "redirect": (10, ["/a", "/a.html", "/favicon.ico", "/blue.png", "/red"]),
+    "calculate-next": (15, None),  # paths made up on the fly, see make_path
+    "calculate-area": (15, None),
+}
+
+
+def make_path(kind: str) -> str:
+    """a random path of the given kind"""
+    if kind == "calculate-next":
+        return f"/calculate-next?num={random.randint(0, 10 ** 6)}"
+    if kind == "calculate-area":
+        return f"/calculate-area?height={random.randint(1, 1000)}&width={random.randint(1, 1000)}"
+    return random.choice(MIX[kind][1])
+
+
+def pick_kind() -> str:
+    """pick a request kind by the MIX weights"""
+    kinds = list(MIX)
+    return random.choices(kinds, weights=[MIX[kind][0] for kind in kinds])[0]
+
+
+def connect(host: str, port: int):
+    sock = socket.create_connection((host, port), timeout=TIMEOUT)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def read_response(sock, buffer: bytearray):
+    """
+    read one response off a keep-alive connection, bytes after it stay in the buffer
+    returns status code, whether the server keeps the connection open and the body size
+    """
+    while b"\r\n\r\n" not in buffer:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError("server closed the connection mid response")
+        buffer += data
+    end = buffer.find(b"\r\n\r\n")
+    lines = bytes(buffer[:end]).decode("latin-1").split("\r\n")
+    del buffer[: end + 4]
+    status = int(lines[0].split(" ")[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    while len(buffer) < length:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError("server closed the connection mid body")
+        buffer += data
+    del buffer[:length]
+    keep_alive = headers.get("connection", "").lower() != "close"
+    return status, keep_alive, length
+
+
+def client(host: str, port: int, deadline: float, results: list):
+    """one connection - send requests back to back until the deadline, reconnect whenever the server closes"""
+    sock = None
+    buffer = bytearray()
+    while time.monotonic() < deadline:
+        kind = pick_kind()
+        request = f"GET {make_path(kind)} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: gzip\r\n\r\n".encode()
+        start = time.perf_counter()
+        try:
+            if sock is None:
+                sock = connect(host, port)
+                buffer = bytearray()
+            sock.sendall(request)
+            status, keep_alive, length = read_response(sock, buffer)
+            results.append((kind, time.perf_counter() - start, status, length))
+            if not keep_alive:
+                sock.close()
+                sock = None
+        except (OSError, ValueError, IndexError) as e:  # timeouts, resets, garbage
+            results.append((kind, time.perf_counter() - start, 0, 0))
+            print(f"Error: {e}")
+            if sock is not None:
+                sock.close()
+            sock = None
+            time.sleep(0.01)  # don't spin on a dead server
+    if sock is not None:
+        sock.close()
+
+
+def percentile(latencies: list, p: float) -> float:
+    """nearest rank percentile of a sorted list, in milliseconds"""
+    if not latencies:
+        return 0.0
+    rank = max(int(round(p / 100 * len(latencies))) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)] * 1000
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    """requests/sec, latency percentiles and error rate, in total and for every kind of request"""
+    def stats(rows):
+        latencies = sorted(row[1] for row in rows)
+        errors = sum(1 for row in rows if row[2] == 0 or row[2] >= 400)  # 0 means no response at all
+        return {
+            "requests": len(rows),
+            "rps": round(len(rows) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "bytes": sum(row[3] for row in rows),
+        }
+
+    summary = stats(results)
+    summary["kinds"] = {kind: stats([row for row in results if row[0] == kind]) for kind in MIX}
+    return summary
+
+
+def print_summary(summary: dict):
+    print(f"{'kind':<16}{'requests':>10}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    rows = list(summary["kinds"].items()) + [("total", summary)]
+    for kind, row in rows:
+        print(
+            f"{kind:<16}{row['requests']:>10}{row['rps']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+            f"{row['p99_ms']:>10}{row['error_rate']:>8.2%}"
+        )
+
+
+def main():
+    args = sys.argv
+    host = args[1] if len(args) > 1 else HOST
+    port = int(args[2]) if len(args) > 2 else PORT
+    connections = int(args[3]) if len(args) > 3 else CONNECTIONS
+    duration = float(args[4]) if len(args) > 4 else DURATION
+    label = args[5] if len(args) > 5 else ""
+
+    print(f"Benchmarking {host}:{port} with {connections} connections for {duration} seconds")
+    results = []  # (kind, latency, status, body size), list.append is thread safe
+    deadline = time.monotonic() + duration
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=client, args=(host, port, deadline, results), daemon=True)
+        for _ in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    record = {
+        "label": label,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": host,
+        "port": port,
+        "connections": connections,
+        "duration": round(elapsed, 3),
+        **summary,
+    }
+    with open(RESULTS_FILE, "a") as file:
+        file.write(json.dumps(record) + "\n")
+    print(f"Results appended to {RESULTS_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,23 @@
 # Purpose: Provide a basis for Ex. 4.4
 # Note: The code is written in a simple way, without classes, log files or other utilities, for educational purpose
 # Usage: Fill the missing functions and constants
+import bisect
+import collections
+import collections.abc
+import email.utils
+import gzip
 import os.path
+import queue
+import selectors
+import signal
 import socket
+import stat
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
 
 # Edited and improved by avi
 
@@ -14,24 +28,162 @@ import sys
 IP = "0.0.0.0"  # listen on all local interfaces
 PORT = 80  # http port
 SOCKET_TIMEOUT = 5  # in seconds
-MAX_LENGTH = 1024  # max msg length in bytes, we are expecting small get requests, so this is plenty ... at same time, don't set too low as we don't want to miss data
-# if we wanted POST, then we would need to increase to handle larger image
-# uploads
+RECV_SIZE = 16384  # in bytes, most we read from a socket at a time, requests bigger than this are read in several goes
+MAX_BODY_SIZE = 1024 * 1024  # in bytes, biggest request body (Content-Length or chunked) we are willing to buffer
+# (room for a full MAX_BATCH batch, about 100 bytes per height,width line)
 
 VER = "HTTP/1.1"  # HTTP version we are using
 
+# persistent connections (HTTP/1.1 keep-alive)
+KEEP_ALIVE_TIMEOUT = 5  # in seconds, how long an idle connection is kept open between requests
+MAX_KEEP_ALIVE_REQUESTS = 100  # requests served on one connection before we close it
+MAX_HEADER_SIZE = 8192  # in bytes, biggest request head (request line + headers) we are willing to buffer, 431 after that
+MAX_CHUNK_LINE = 1024  # in bytes, longest chunk size line (with extensions) of a chunked body, 400 after that
+
+# concurrency - one slow client should not hold up everyone else
+SERVE_MODE = "threads"  # "serial" (one client at a time, the original way), "threads" (worker pool) or "events" (selectors loop)
+WORKER_COUNT = 16  # how many worker threads serve clients in "threads" mode
+ACCEPT_QUEUE_SIZE = 64  # accepted clients waiting for a free worker, clients past that get a 503 (see OVERLOAD)
+SELECT_INTERVAL = 1  # in seconds, how often the events loop wakes up to drop idle clients
+SERVE_MODES = ("serial", "threads", "events", "prefork")
+
+# prefork - one python process only gets one core, so start several that all listen on PORT (SO_REUSEPORT)
+PROCESS_COUNT = os.cpu_count() or 1  # worker processes in "prefork" mode
+PREFORK_ENGINE = "events"  # how every worker process serves its clients, "events" or "threads"
+RESTART_DELAY = 1  # in seconds, wait before restarting a crashed worker process so a crash loop doesn't eat the cpu
+BIND_FAILED = 3  # exit code of a worker process that could not listen, restarting it won't help
+
+# accepted client sockets waiting for a worker thread (threads mode)
+CLIENT_QUEUE = queue.Queue(maxsize=ACCEPT_QUEUE_SIZE)
+
+# overload protection - clients we can't take right away get a quick 503 instead of waiting in line, and a client
+# trickling in its request (slowloris) is dropped after HEADER_TIMEOUT instead of holding a worker
+MAX_CONNECTIONS = 1024  # open client connections at once (queued ones included), more than that get a 503
+HEADER_TIMEOUT = 10  # in seconds, a request head has to be in by then, however slowly it trickles in
+RETRY_AFTER = 1  # in seconds, when a client we turned away should try again
+OVERLOAD = (
+    f"{VER} 503 Service Unavailable\r\nRetry-After: {RETRY_AFTER}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+).encode()  # ready made, turning a client away should cost next to nothing
+
+# static file cache - the webroot is small and hot, no need to read it from disk on every GET
+CACHE_MAX_BYTES = 32 * 1024 * 1024  # total size of file bodies kept in memory
+CACHE_MAX_FILE_SIZE = 1024 * 1024  # bigger files are read from disk every time
+# files bigger than CACHE_MAX_FILE_SIZE are streamed with sendfile instead, memory per response stays constant
+SENDFILE_CHUNK = 256 * 1024  # in bytes, most we push from a file per non-blocking send (events mode)
+FILE_CACHE = collections.OrderedDict()  # file path -> cache entry, least recently used first
+CACHE_LOCK = threading.Lock()  # worker threads share the cache
+CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+# precompressed variants of text files, built once per file version and kept in the cache next to the raw body
+COMPRESS_TYPES = ("text/html", "text/css", "text/javascript", "text/plain")
+COMPRESS_LEVEL = 9  # we only compress once per file, so might as well squeeze it
+ENCODINGS = ("gzip", "deflate")  # content encodings we can build, preferred first
+
+# webroot manifest - every file is looked at once at startup (meta_code), then re-scanned in the background
+MANIFEST_REFRESH = 2  # in seconds, how often the webroot is checked for new, changed or deleted files
+MANIFEST = {}  # url path -> manifest entry (see manifest_entry)
+REDIRECTS = {}  # url path -> ready made 302 response
+
+DEFAULT_URL = "/index.html"
+INDEX_URLS = (
+    "",
+    "/",
+    "/index",
+    "/index.htm",
+    "/home",
+)  # these should give a 200 ok, and "redirect" but not a 302
+
+# check if URL had been redirected, not available or other error code. For
+# example:
+REDIRECTION_DICTIONARY = {
+    "/a.html": "/avi.html",
+    "/a": "/avi.html",
+    "/favicon.ico": "/imgs/favicon.ico",
+    "/blue.png": "/imgs/blue.png",
+    "/red": "/imgs/blue.png",
+}
+
+DEF_TYPE = "text/plain"  # default to this type
+# extract requested file type from URL (html, jpg etc)
+TYPES = {
+    "html": "text/html",
+    "txt": DEF_TYPE,
+    "text": DEF_TYPE,
+    "js": "text/javascript",
+    "css": "text/css",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "ico": "image/x-icon",
+    "gif": "image/gif",
+}  # favicon, can either be x-icon or a microsoft format
+
+# /calculate-x answers are plain text
+QUESTION_HEADER = f"{VER} 200 OK\r\nContent-Type: {DEF_TYPE}\r\nContent-Length: "
+
+# uploads - POST or PUT under UPLOAD_PREFIX stores the body as that file in the webroot. the body is streamed to a temp
+# file next to the target as it arrives (memory stays at one RECV_SIZE per upload), then moved into place in one step
+UPLOAD_PREFIX = "/uploads/"  # the only place clients may write to
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # in bytes, checked against Content-Length before any of the body is read
+UPLOAD_TEMP_PREFIX = ".upload-"  # unfinished uploads, never served
+UPLOAD_MODE = 0o644  # permissions of uploaded files, like the rest of the webroot (temp files start out 0600)
+CONTINUE = f"{VER} 100 Continue\r\n\r\n".encode()  # go ahead for clients that sent Expect: 100-continue
+
+# batch questions - many numbers or triangles in one request, as query lists (GET) or in the body (POST)
+BATCH_NEXT_URL = "/calculate-next-batch"
+BATCH_AREA_URL = "/calculate-area-batch"
+BATCH_URLS = (BATCH_NEXT_URL, BATCH_AREA_URL)
+MAX_BATCH = 10000  # most items in one batch request, 413 after that (a POST body also has MAX_BODY_SIZE)
+FORM_TYPE = "application/x-www-form-urlencoded"  # POST body with the same fields as the query (num=1,2,3)
+
+# generated responses (batch answers) are sent as they are made, with Transfer-Encoding: chunked
+BATCH_SLICE = 512  # batch items answered per chunk, this is what sets the chunk size
+LAST_CHUNK = b"0\r\n\r\n"  # ends a chunked body
+
+# byte range requests (206 Partial Content)
+MAX_RANGES = 16  # more ranges than this in one request and we just send the whole file
+RANGE_BOUNDARY = "byteranges_" + os.urandom(8).hex()  # separates the parts of a multiple ranges response
+
+# logging - printing on the request path is slow under load, so it is off unless asked for
+VERBOSE = False  # per request diagnostics (headers, results, connections...) printed as they happen
+ACCESS_LOG = True  # one line per request (method, path, status, bytes, duration), written by a background thread
+ACCESS_LOG_FILE = None  # path the access log is appended to, None for stdout
+LOG_QUEUE_SIZE = 10000  # records waiting to be written, more than that and they are dropped (counted in LOG_STATS)
+LOG_BATCH = 512  # most records written (and flushed) at once
+LOG_FLUSH_INTERVAL = 0.5  # in seconds, longest a record waits for a batch to fill up
+LOG_QUEUE = queue.Queue(maxsize=LOG_QUEUE_SIZE)  # finished requests (see access_record) waiting for the log thread
+LOG_STATS = {"written": 0, "dropped": 0}
+
+# live counters on a reserved path, in the prometheus text format - recording is a few additions under a lock
+METRICS = True  # count requests (status, bytes, latency per route) and answer METRICS_URL
+METRICS_URL = "/metrics"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)  # in seconds
+METRIC_ROUTES = ("/calculate-next", "/calculate-area", METRICS_URL) + BATCH_URLS  # other requests are grouped (see request_route)
+METRICS_LOCK = threading.Lock()  # worker threads share the counters
+METRICS_STATS = {
+    "statuses": {},  # status code -> requests
+    "bytes": 0,  # response bytes sent, headers included
+    "routes": {},  # route -> {"count", "sum" (seconds), "buckets" (one per LATENCY_BUCKETS and one past the last)}
+    "connections": 0,  # open client connections
+    "accepted": 0,  # client connections since we started
+    "rejected": 0,  # clients turned away with a 503 (MAX_CONNECTIONS or a full accept queue)
+    "timeouts": 0,  # clients dropped for not sending their request head in HEADER_TIMEOUT
+}
+
 
 def calc_area(msg: str):
     """
     Calculate the area of a triangle given the height and width
     """
     if "&" not in msg or msg.count("=") != 2:  # check for correct format
-        print("Invalid query string")
+        if VERBOSE:
+            print("Invalid query string")
         return False, "Invalid query"  # error
 
     in1 = msg.split("&")  # split the query string
     if len(in1) != 2:  # check for correct number of parameters
-        print("Invalid query parameter count")
+        if VERBOSE:
+            print("Invalid query parameter count")
         return False, "Wrong number of parameters"  # error
     before = in1[0].split("=")  # split the parameters
     after = in1[1].split("=")
@@ -51,19 +203,23 @@ def calc_area(msg: str):
             height = s_num
             width = f_num
         else:
-            print("Invalid parameter names")
+            if VERBOSE:
+                print("Invalid parameter names")
             return False, "Invalid parameter names"  # error
     elif f_num <= 0 or s_num <= 0:
-        print("We only accept positive numbers")
+        if VERBOSE:
+            print("We only accept positive numbers")
         return False, "We only accept positive numbers"  # error not natural
     else:
-        print(f"Invalid result {f_num} {s_num}")
+        if VERBOSE:
+            print(f"Invalid result {f_num} {s_num}")
         return (
             False,
             "At least one of the inputs is not a valid number",
         )  # todo throw some error
 
-    print(f"height: {height}, width: {width}")  # print the values
+    if VERBOSE:
+        print(f"height: {height}, width: {width}")  # print the values
     return True, str((height * width) / 2)
 
 
@@ -83,6 +239,86 @@ def calc_next(query: str, url: str):
         return False, "First (and only) parameter should be num"
 
 
+def calc_next_batch(nums: list) -> list:
+    """
+    calc_next for a whole list of numbers (strings) in one pass, one result string per number
+    a bad number gets an error line instead of failing the rest of the batch
+    """
+    results = []
+    for num in nums:
+        worked, value = to_int(num)
+        results.append(str(value + 1) if worked else f"error: {num} is not a natural number")
+    return results
+
+
+def calc_area_batch(pairs: list) -> list:
+    """calc_area for a whole list of (height, width) strings in one pass, one result string (or error line) per pair"""
+    results = []
+    for height, width in pairs:
+        f_num = to_float(height)
+        s_num = to_float(width)
+        if f_num and s_num:
+            results.append(str((f_num * s_num) / 2))
+        else:
+            results.append(f"error: {height}, {width} are not both positive numbers")
+    return results
+
+
+def batch_input(page: str, query: str, body: bytes, content_type: str = ""):
+    """
+    the items of a batch request - from a POST body (numbers separated by commas or whitespace, or one height,width
+    pair per line) or from the query (num=1,2,3 or height=3,5&width=4,6, a name may also repeat). a form encoded
+    POST body (FORM_TYPE) is read like the query
+    returns success and the list of numbers or (height, width) pairs, or an error message
+    """
+    if body and content_type.split(";")[0].strip().lower() == FORM_TYPE:
+        query, body = body.decode("utf-8", "replace"), b""
+    if body:
+        text = body.decode("utf-8", "replace")
+        if page == BATCH_NEXT_URL:
+            return True, text.replace(",", " ").split()
+        pairs = []
+        for line in text.splitlines():
+            values = line.replace(",", " ").split()
+            if not values:  # blank line
+                continue
+            if len(values) != 2:
+                return False, f"Expected height,width on every line, got: {line}"
+            pairs.append((values[0], values[1]))
+        return True, pairs
+
+    params = urllib.parse.parse_qs(query)  # name -> every value it was given, in order
+    def values(name):
+        return [item for value in params.get(name, []) for item in value.split(",")]
+
+    if page == BATCH_NEXT_URL:
+        return True, values("num")
+    heights = values("height")
+    widths = values("width")
+    if len(heights) != len(widths):
+        return False, "There should be as many heights as widths"
+    return True, list(zip(heights, widths))
+
+
+def batch_response(page: str, query: str, body: bytes = b"", content_type: str = "") -> list:
+    """handle a batch question (BATCH_URLS), returns the response to send - one result per line, in order"""
+    worked, items = batch_input(page, query, body, content_type)
+    if not worked:
+        return [error_response("400 Bad Request", False, items)]
+    if not items:
+        return [error_response("400 Bad Request", False, "Nothing to calculate")]
+    if len(items) > MAX_BATCH:
+        return [error_response("413 Payload Too Large", False, f"At most {MAX_BATCH} items per batch")]
+    return stream_response(QUESTION_HEADER, batch_results(page, items))
+
+
+def batch_results(page: str, items: list):
+    """generator - answer a batch BATCH_SLICE items at a time, one result per line, so the first lines go out early"""
+    calc = calc_next_batch if page == BATCH_NEXT_URL else calc_area_batch
+    for first in range(0, len(items), BATCH_SLICE):
+        yield ("\n".join(calc(items[first: first + BATCH_SLICE])) + "\n").encode()
+
+
 def get_file_data(filename: str):
     """Get data from file"""
     try:  # read as binary file
@@ -97,6 +333,402 @@ def get_file_data(filename: str):
     return False, None
 
 
+def file_stat(filename: str):
+    """os.stat of the file, None if it is missing or not a regular file"""
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+    return info if stat.S_ISREG(info.st_mode) else None
+
+
+def file_type(url: str) -> str:
+    """content type of a file from its extension, via the TYPES dictionary"""
+    # get last element (if there are multiple dots, we only care about
+    # extension)
+    return TYPES.get(url.split(".")[-1], DEF_TYPE)  # all other headers
+
+
+def manifest_entry(filename: str, info) -> dict:
+    """
+    everything a GET needs to know about a file, worked out once per file version (mtime and size):
+    content type, validators (ETag from size and mtime, Last-Modified) and the response header, ready to send
+    """
+    filetype = file_type(filename)
+    header = f"{VER} 200 OK\r\nContent-Type: {filetype}"
+    if filetype in (
+        "html",
+        "txt",
+        "text",
+        "js",
+            "css"):  # human readable files (text)
+        header += (
+            "charset=UTF-8"  # add charset utf-8 encoding to text related files only
+        )
+    # text is worth sending compressed if the client takes it, variants live in the cache
+    compressible = filetype in COMPRESS_TYPES and info.st_size <= CACHE_MAX_FILE_SIZE
+    if compressible:
+        header += "\r\nVary: Accept-Encoding"
+    etag = f'"{info.st_size:x}-{info.st_mtime_ns:x}"'
+    modified = email.utils.formatdate(info.st_mtime, usegmt=True)
+    header += f"\r\nAccept-Ranges: bytes\r\nLast-Modified: {modified}\r\nContent-Length: "
+    return {
+        "path": filename,
+        "info": info,
+        "type": filetype,
+        "compressible": compressible,
+        "etag": etag,
+        "modified": modified,
+        "header": header,  # up to the Content-Length value, for the variants, ranges etc
+        "head": f"{add_header_line(header, f'ETag: {etag}')}{info.st_size}\r\n\r\n".encode(),  # plain 200
+    }
+
+
+def refresh_manifest(file_path: str):
+    """
+    walk the webroot and bring MANIFEST up to date - new files are added, files with a different mtime or size get
+    a new entry and deleted files are dropped. unchanged files cost only their stat
+    """
+    seen = set()
+    for folder, _, filenames in os.walk(file_path):
+        for name in filenames:
+            if name.startswith(UPLOAD_TEMP_PREFIX):  # upload still coming in
+                continue
+            filename = os.path.join(folder, name)
+            info = file_stat(filename)
+            if info is None:
+                continue
+            url = "/" + os.path.relpath(filename, file_path).replace(os.sep, "/")
+            seen.add(url)
+            known = MANIFEST.get(url)
+            if (
+                known is None
+                or known["info"].st_mtime_ns != info.st_mtime_ns
+                or known["info"].st_size != info.st_size
+            ):
+                MANIFEST[url] = manifest_entry(filename, info)  # single assignment, thread safe
+    for url in list(MANIFEST):
+        if url not in seen:
+            MANIFEST.pop(url, None)
+
+
+def watch_manifest(file_path: str):
+    """background thread - re-scan the webroot every MANIFEST_REFRESH seconds"""
+    while True:
+        time.sleep(MANIFEST_REFRESH)
+        try:
+            refresh_manifest(file_path)
+        except Exception as e:
+            print("Manifest error: ", e)
+
+
+def build_manifest(file_path: str, watch: bool = True):
+    """
+    startup scan of the webroot, ready made redirects, and (watch) the thread that keeps the manifest fresh.
+    the prefork parent serves nothing and forks, so it leaves the watcher to its workers
+    """
+    refresh_manifest(file_path)
+    for url, location in REDIRECTION_DICTIONARY.items():
+        # 302 redirection response and location for the new url
+        REDIRECTS[url] = f"{VER} 302 Found\r\nLocation: {location}\r\nContent-Length: 0\r\n\r\n".encode()
+    if watch:
+        start_manifest_watcher(file_path)
+    print(f"Manifest built: {len(MANIFEST)} files in {file_path}")
+
+
+def start_manifest_watcher(file_path: str):
+    """start the thread that keeps the manifest fresh (in every prefork worker, threads don't survive a fork)"""
+    threading.Thread(
+        target=watch_manifest, args=(file_path,), name="manifest", daemon=True
+    ).start()
+
+
+def manifest_lookup(url: str, file_path: str):
+    """
+    manifest entry of the url, None if there is no such file. every lookup costs one stat, so a file changed,
+    deleted or created since the last scan is served as it is now (the scan only saves building entries),
+    as long as the path stays inside the webroot
+    """
+    meta = MANIFEST.get(url)
+    if meta is not None:
+        info = file_stat(meta["path"])
+        if info is None:  # deleted since the last scan
+            MANIFEST.pop(url, None)
+            return None
+        if info.st_mtime_ns == meta["info"].st_mtime_ns and info.st_size == meta["info"].st_size:
+            return meta
+        meta = MANIFEST[url] = manifest_entry(meta["path"], info)  # changed, new validators and header
+        return meta
+    root = os.path.normpath(file_path)
+    filename = os.path.normpath(file_path + url)  # add file_path before filename
+    if not filename.startswith(root + os.sep):  # ../ tricks
+        return None
+    if os.path.basename(filename).startswith(UPLOAD_TEMP_PREFIX):  # upload still coming in
+        return None
+    info = file_stat(filename)
+    if info is None:
+        return None
+    meta = MANIFEST[url] = manifest_entry(filename, info)
+    return meta
+
+
+def variant_etag(etag: str, encoding) -> str:
+    """every compressed variant needs its own ETag, the raw body keeps the file's"""
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def not_modified(request: dict, etag: str, info) -> bool:
+    """
+    True if the client's copy is still good (If-None-Match / If-Modified-Since), so a 304 is enough
+    If-None-Match wins when both are sent, and is compared weakly (W/ prefix ignored) as the RFC says for GET
+    """
+    if_none_match = get_header(request, "If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+    if_modified_since = get_header(request, "If-Modified-Since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError, IndexError):  # bad date, ignore the header
+        return False
+    return int(info.st_mtime) <= since  # http dates have no fractions of a second
+
+
+def not_modified_response(etag: str, modified: str, vary: bool) -> bytes:
+    """header only 304 response, with the validators so the client can keep using them"""
+    header = f"{VER} 304 Not Modified\r\nETag: {etag}\r\nLast-Modified: {modified}\r\n"
+    if vary:
+        header += "Vary: Accept-Encoding\r\n"
+    return (header + "\r\n").encode()
+
+
+def parse_ranges(range_header: str, size: int):
+    """
+    parse a Range header (bytes=0-99,200-,-500) against a file of the given size
+    returns a sorted list of (first, last) byte positions with overlapping or touching ranges merged,
+    an empty list if none of them is satisfiable (416), or None if the header should be ignored (bad syntax, other
+    units, too many ranges) and the whole file sent
+    """
+    unit, _, specs = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = (text.strip() for text in spec.partition("-"))
+        if (
+            not dash
+            or not (first or last)
+            or (first and not first.isdigit())
+            or (last and not last.isdigit())
+        ):
+            return None  # bad syntax
+        if not first:  # suffix range, the last n bytes
+            if int(last) > 0 and size > 0:  # an empty file has no last bytes
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None  # bad syntax
+        last = int(last) if last else size - 1
+        if first < size:  # ranges starting past the end are skipped
+            ranges.append((first, min(last, size - 1)))
+
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:  # overlaps or touches the previous one
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def if_range_matches(request: dict, etag: str, modified: str) -> bool:
+    """If-Range - the client only wants the ranges if its copy is still current (strong ETag or exact date match)"""
+    if_range = get_header(request, "If-Range")
+    if if_range is None:
+        return True
+    if if_range.startswith(("\"", "W/")):  # an ETag, weak ones never match
+        return if_range == etag
+    return if_range == modified
+
+
+def range_response(meta: dict, ranges: list) -> list:
+    """
+    206 response for the given ranges of a file (see parse_ranges), 416 if there are none. every range is sent
+    straight from its offset in the file, one range is sent as is, several go in a multipart/byteranges body
+    """
+    size = meta["info"].st_size
+    if not ranges:
+        return [
+            f"{VER} 416 Range Not Satisfiable\r\nContent-Range: bytes */{size}\r\nContent-Length: 0\r\n\r\n".encode()]
+    header = add_header_line(meta["header"], f"ETag: {meta['etag']}")
+    header = header.replace(" 200 OK", " 206 Partial Content", 1)
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        header = add_header_line(header, f"Content-Range: bytes {first}-{last}/{size}")
+        return [f"{header}{last - first + 1}\r\n\r\n".encode(), (meta["path"], first, last - first + 1)]
+
+    header = header.replace(
+        f"Content-Type: {meta['type']}", f"Content-Type: multipart/byteranges; boundary={RANGE_BOUNDARY}", 1)
+    parts = [None]  # the header goes first, once we know the length
+    length = 0
+    for first, last in ranges:
+        part_header = (
+            f"\r\n--{RANGE_BOUNDARY}\r\nContent-Type: {meta['type']}\r\n"
+            f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n"
+        ).encode()
+        parts += [part_header, (meta["path"], first, last - first + 1)]
+        length += len(part_header) + last - first + 1
+    closing = f"\r\n--{RANGE_BOUNDARY}--\r\n".encode()
+    parts.append(closing)
+    length += len(closing)
+    parts[0] = f"{header}{length}\r\n\r\n".encode()
+    return parts
+
+
+def add_header_line(header: str, line: str) -> str:
+    """add a line to a response header that is still waiting for its Content-Length value"""
+    return header.replace("\r\nContent-Length: ", f"\r\n{line}\r\nContent-Length: ")
+
+
+def entry_bytes(entry: dict) -> int:
+    """memory a cache entry holds, raw body plus every compressed variant"""
+    return len(entry["data"]) + sum(
+        len(variant[1]) for variant in entry["variants"].values() if variant is not None
+    )
+
+
+def cache_evict():
+    """drop least recently used files until we are back under CACHE_MAX_BYTES (caller holds CACHE_LOCK)"""
+    while CACHE_STATS["bytes"] > CACHE_MAX_BYTES and FILE_CACHE:
+        _, evicted = FILE_CACHE.popitem(last=False)  # least recently used
+        CACHE_STATS["bytes"] -= entry_bytes(evicted)
+        CACHE_STATS["evictions"] += 1
+
+
+def cache_store(filename: str, entry: dict):
+    """add a file to the cache, then drop least recently used files until we are back under CACHE_MAX_BYTES"""
+    with CACHE_LOCK:
+        old = FILE_CACHE.pop(filename, None)
+        if old is not None:  # file changed on disk, replace it
+            CACHE_STATS["bytes"] -= entry_bytes(old)
+        FILE_CACHE[filename] = entry
+        CACHE_STATS["bytes"] += entry_bytes(entry)
+        cache_evict()
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """compress a body for the given content encoding (deflate in HTTP means the zlib format)"""
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+    return zlib.compress(data, COMPRESS_LEVEL)
+
+
+def get_variant(meta: dict, entry: dict, encoding: str):
+    """
+    header and body of the compressed variant of a cached file, compressed on the first request and kept in the entry
+    None if compressing doesn't make the file smaller
+    """
+    with CACHE_LOCK:
+        if encoding in entry["variants"]:
+            return entry["variants"][encoding]
+
+    data = compress(entry["data"], encoding)  # outside the lock, other threads can keep going
+    if len(data) < len(entry["data"]):
+        header = add_header_line(
+            meta["header"], f"Content-Encoding: {encoding}\r\nETag: {variant_etag(meta['etag'], encoding)}")
+        variant = (f"{header}{length_bytes(data)}\r\n\r\n".encode(), data)
+    else:  # remember it's not worth it, so we don't try again
+        variant = None
+    with CACHE_LOCK:
+        if encoding not in entry["variants"]:  # another thread may have beaten us to it
+            entry["variants"][encoding] = variant
+            if FILE_CACHE.get(meta["path"]) is entry:  # still cached, count the extra memory
+                CACHE_STATS["bytes"] += len(data) if variant is not None else 0
+                cache_evict()
+        return entry["variants"][encoding]
+
+
+def settle_encoding(meta: dict, encoding):
+    """
+    the encoding the file will really be sent in: None if the cache already knows compressing this version of it
+    doesn't help (get_variant kept None), so the ETag for the 304 check is the one the client got
+    """
+    if encoding is None:
+        return None
+    with CACHE_LOCK:
+        entry = FILE_CACHE.get(meta["path"])
+        if (
+            entry is not None
+            and entry["mtime"] == meta["info"].st_mtime_ns
+            and entry["size"] == meta["info"].st_size
+            and encoding in entry["variants"]
+            and entry["variants"][encoding] is None
+        ):
+            return None
+    return encoding
+
+
+def get_cached_file(meta: dict, encoding=None):
+    """
+    Get the response header and body of a file (manifest entry), from memory if it is the same version of the file
+    (same mtime and size). encoding asks for a compressed variant (see choose_encoding), we fall back to the raw body
+    if there is none
+    returns success, header bytes and body (like get_file_data, success is False if the file can't be read)
+    """
+    filename = meta["path"]
+    info = meta["info"]
+    with CACHE_LOCK:
+        entry = FILE_CACHE.get(filename)
+        if (
+            entry is not None
+            and entry["mtime"] == info.st_mtime_ns
+            and entry["size"] == info.st_size
+        ):  # still the same file
+            FILE_CACHE.move_to_end(filename)  # most recently used
+            CACHE_STATS["hits"] += 1
+        else:
+            entry = None
+            CACHE_STATS["misses"] += 1
+
+    if entry is None:
+        res, data = get_file_data(filename)  # read outside the lock, other threads can keep going
+        if not res:
+            return False, None, None
+        if len(data) != info.st_size:  # changed since the manifest saw it, don't cache and don't bother compressing
+            header = add_header_line(meta["header"], f"ETag: {meta['etag']}")
+            return True, f"{header}{length_bytes(data)}\r\n\r\n".encode(), data
+        entry = {
+            "mtime": info.st_mtime_ns,
+            "size": info.st_size,
+            "data": data,
+            "variants": {},  # content encoding -> (header, body), None if compressing didn't help
+        }
+        cache_store(filename, entry)
+
+    if encoding is not None:
+        variant = get_variant(meta, entry, encoding)
+        if variant is not None:
+            return True, variant[0], variant[1]
+    return True, meta["head"], entry["data"]
+
+
+def cache_stats() -> dict:
+    """copy of the cache counters, with the number of cached files and the hit rate"""
+    with CACHE_LOCK:
+        stats = dict(CACHE_STATS, files=len(FILE_CACHE))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
 def to_float(msg: str):
     """
     check if the string is a number, if so, return the float value, otherwise return False (remove 1 decimal and then check if numeric, then can convert and keep decimal)
@@ -114,7 +746,8 @@ def to_int(msg: str):
     elif s.isnumeric():
         return True, int(s)
     else:
-        print("Not a number")
+        if VERBOSE:
+            print("Not a number")
         return False, None
 
 
@@ -129,76 +762,63 @@ def length_bytes(s) -> str:
     return str(len(s.encode("utf-8"))) if isinstance(s, str) else str(len(s))
 
 
-def handle_client_request(resource: str, client_socket, file_path: str):
+def handle_client_request(
+        resource: str,
+        client_socket,
+        file_path: str,
+        request: dict = None):
     """Check the required resource, generate proper HTTP response and send to client"""
-    DEFAULT_URL = "/index.html"
-
-    if resource in (
-        "",
-        "/",
-        "/index",
-        "/index.htm",
-        "/home",
-    ):  # these should give a 200 ok, and "redirect" but not a 302
-        url = DEFAULT_URL
-    else:
-        url = resource
-
-    # check if URL had been redirected, not available or other error code. For
-    # example:
-    REDIRECTION_DICTIONARY = {
-        "/a.html": "/avi.html",
-        "/a": "/avi.html",
-        "/favicon.ico": "/imgs/favicon.ico",
-        "/blue.png": "/imgs/blue.png",
-        "/red": "/imgs/blue.png",
-    }
+    send_parts(client_socket, create_response(resource, file_path, request))
 
-    if url in REDIRECTION_DICTIONARY:
-        url = REDIRECTION_DICTIONARY[
-            url
-        ]  # we search by key and trade variables for value
-        client_socket.send(
-            f"{VER} 302 Found\r\nLocation: {url}\r\n".encode()
-        )  # send 302 redirection response and location for the new url
-        return  # we don't need to process further
-
-    def_type = "text/plain"  # default to this type
-    # extract requested file type from URL (html, jpg etc)
-    TYPES = {
-        "html": "text/html",
-        "txt": def_type,
-        "text": def_type,
-        "js": "text/javascript",
-        "css": "text/css",
-        "jpg": "image/jpeg",
-        "jpeg": "image/jpeg",
-        "png": "image/png",
-        "ico": "image/x-icon",
-        "gif": "image/gif",
-    }  # favicon, can either be x-icon or a microsoft format
 
-    # get last element (if there are multiple dots, we only care about
-    # extension)
-    filetype = url.split(".")[-1]
-    if filetype in TYPES:
-        filetype = TYPES[filetype]  # via dictionary, get the correct type
-    else:
-        filetype = def_type  # all other headers
+def choose_encoding(request: dict):
+    """
+    the content encoding (from ENCODINGS) the client's Accept-Encoding header likes best, None for the raw bytes
+    q values are honored, q=0 means never, ties go to the order of ENCODINGS
+    """
+    accept = get_header(request, "Accept-Encoding")
+    if not accept:
+        return None
+    weights = {}  # encoding -> q value
+    for item in accept.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name == "*":  # anything we have, unless named on its own
+            for encoding in ENCODINGS:
+                weights.setdefault(encoding, q)
+        elif name in ENCODINGS:
+            weights[name] = q
+    best = None
+    for encoding in ENCODINGS:
+        if weights.get(encoding, 0) > 0 and (
+                best is None or weights[encoding] > weights[best]):
+            best = encoding
+    return best
 
-    header = f"{VER} 200 OK\r\nContent-Type: {filetype}"
-    if filetype in (
-        "html",
-        "txt",
-        "text",
-        "js",
-            "css"):  # human readable files (text)
-        header += (
-            "charset=UTF-8"  # add charset utf-8 encoding to text related files only
-        )
 
-    header += "\r\nContent-Length: "  # for any valid request, we add this
-    print(f"filename requested: {url}")
+def create_response(resource: str, file_path: str, request: dict = None) -> list:
+    """
+    Check the required resource and generate the proper HTTP response (shared by every serving mode)
+    request is the parsed request (see parse_request), for the headers that change the response (Accept-Encoding, If-None-Match, Range...)
+    the response is a list of parts to send in order: bytes, or (filename, offset, count) for a piece of a file
+    """
+    url = DEFAULT_URL if resource in INDEX_URLS else resource
+
+    redirect = REDIRECTS.get(url)
+    if redirect is not None:
+        return [redirect]  # ready made 302, we don't need to process further
+    if url == METRICS_URL and METRICS:
+        return [metrics_response()]
+
+    if VERBOSE:
+        print(f"filename requested: {url}")
 
     if "?" in url:  # query param exists
         quest = url.split("?")
@@ -206,53 +826,110 @@ def handle_client_request(resource: str, client_socket, file_path: str):
         query = quest[1]
         if page == "/calculate-next":
             worked, response = calc_next(query, url)
-            handle_question(worked, response, header, client_socket)
-            return
+            return [handle_question(worked, response, QUESTION_HEADER)]
         elif page == "/calculate-area":  # send to calc area function
             worked, response = calc_area(query)
-            handle_question(worked, response, header, client_socket)
-            return
+            return [handle_question(worked, response, QUESTION_HEADER)]
+        elif page in BATCH_URLS:
+            return batch_response(page, query)
+        return [error_response("404 Not Found")]  # query on anything else
     else:  # resource as file
-        user_file = file_path + url  # add file_path before filename
-        if os.path.isfile(user_file):
-            res, data = get_file_data(
-                user_file
-            )  # read the data from the file (current working directory)
-            if not res:  # issue with file
+        meta = manifest_lookup(url, file_path)
+        if meta is None:
+            return [error_response("404 Not Found")]  # not a file
+        return file_response(meta, request)
+
+
+def file_response(meta: dict, request: dict) -> list:
+    """response for a static file (manifest entry): 304, 206, streamed from disk, or from the cache"""
+    size = meta["info"].st_size
+    encoding = None
+    range_header = get_header(request, "Range")
+    if meta["compressible"] and range_header is None:  # ranges are always of the raw file
+        encoding = settle_encoding(meta, choose_encoding(request))
+    etag = variant_etag(meta["etag"], encoding)
+    if not_modified(request, etag, meta["info"]):
+        if VERBOSE:
+            print(f"Not modified: {meta['path']}")
+        return [not_modified_response(etag, meta["modified"], meta["compressible"])]
+
+    if range_header is not None and if_range_matches(request, meta["etag"], meta["modified"]):
+        ranges = parse_ranges(range_header, size)
+        if ranges is not None:  # otherwise ignore the header and send it all
+            if not os.access(meta["path"], os.R_OK):
                 print("Error reading file - likely permissions issue")
-                client_socket.send(
-                    error_response("403 Forbidden")
-                )  # file with no read permissions
-                return
-            elif data is None:
-                print("No data in file")
-                client_socket.send(
-                    error_response("204 No Content")
-                )  # file with no data
-                return
-        else:
-            client_socket.send(error_response("404 Not Found"))  # not a file
-            return
+                return [error_response("403 Forbidden")]
+            if VERBOSE:
+                print(f"Ranges requested: {meta['path']} {ranges}")
+            return range_response(meta, ranges)
+
+    if size > CACHE_MAX_FILE_SIZE:
+        # too big to keep in memory, the header goes out first and then the file is streamed from disk
+        if not os.access(meta["path"], os.R_OK):
+            print("Error reading file - likely permissions issue")
+            return [error_response("403 Forbidden")]
+        if VERBOSE:
+            print(meta["head"].decode())
+        return [meta["head"], (meta["path"], 0, size)]
+
+    res, head, data = get_cached_file(
+        meta, encoding
+    )  # read the data from memory or from the file (current working directory)
+    if not res:  # issue with file
+        print("Error reading file - likely permissions issue")
+        # file with no read permissions
+        return [error_response("403 Forbidden")]
+    elif data is None:
+        print("No data in file")
+        return [error_response("204 No Content")]  # file with no data
+
+    # header is already encoded and has the length of the data
+    if VERBOSE:
+        print(head.decode())
+    # data is a file in binary format, so no need to encode that part (or copy it next to the header)
+    return [head, data]
+
+
+def stream_response(header: str, chunks) -> list:
+    """
+    response with a generated body - chunks is a generator of bytes, made while the response is sent (see
+    finish_stream). header is like QUESTION_HEADER, waiting for its Content-Length value
+    """
+    return [f"{header.removesuffix('Content-Length: ')}Transfer-Encoding: chunked\r\n\r\n".encode(), chunks]
+
 
-        # append length of data to header
-        header += f"{length_bytes(data)}\r\n\r\n"
-        print(header)
-        # encode http_header before concatenating with data
-        client_socket.send(
-            header.encode() + data
-        )  # data is a file in binary format, so no need to encode that part
+def chunk_stream(chunks):
+    """generator - frame a generated body for Transfer-Encoding: chunked, size line before every chunk"""
+    for chunk in chunks:
+        if chunk:  # an empty chunk would end the body
+            yield b"%x\r\n%s\r\n" % (len(chunk), chunk)
+    yield LAST_CHUNK
 
 
-def handle_question(worked: bool, response: str, header: str, client_socket):
-    """handle the end result for /calculate-x requests"""
+def finish_stream(parts: list, request: dict) -> list:
+    """
+    a generated body (see stream_response) is framed as chunks, except for HTTP/1.0 clients that don't know chunked
+    encoding - they get it all built up front, with a Content-Length
+    """
+    if len(parts) < 2 or not isinstance(parts[1], collections.abc.Iterator):
+        return parts
+    if request["line"].endswith("HTTP/1.0"):
+        body = b"".join(parts[1])
+        return [parts[0].replace(b"Transfer-Encoding: chunked", f"Content-Length: {len(body)}".encode(), 1), body]
+    return [parts[0], chunk_stream(parts[1])]
+
+
+def handle_question(worked: bool, response: str, header: str) -> bytes:
+    """handle the end result for /calculate-x requests, returns the response to send"""
     if worked:
         # concatenate the header with the response
         header += f"{length_bytes(response)}\r\n\r\n{response}"
-        print(f"Result is: {header}")  # print the header
-        client_socket.send(header.encode())  # encode and then
+        if VERBOSE:
+            print(f"Result is: {header}")  # print the header
+        return header.encode()  # encode and then send
     else:
-        client_socket.send(
-            error_response("500 Internal Server Error", False, response)
+        return error_response(
+            "500 Internal Server Error", False, response
         )  # fallback to error
 
 
@@ -262,15 +939,566 @@ def error_response(
         details: str = ""):
     """Generate an error response with the given error code and details"""
     deet = ""
-    if page:
+    if error.startswith("204"):  # no content means no body at all
+        data = ""
+        content_type = "text/plain"
+    elif page:
         if details != "" and details is not None:
             deet = f"<p>{details}</p>"  # add details to page
 
         data = f"""<html><body><h1>{error}</h1>{deet}<a href="http://127.0.0.1:80">Go Back Home</a></body></html>
                     """  # simple error page
+        content_type = "text/html"
     else:
         data = details + "\r\n\r\n"  # not a page, just a text/plain response
-    return (f"{VER} {error}\r\n\r\n{data}").encode()
+        content_type = "text/plain"
+    # length is needed so a keep-alive client knows where the next response starts
+    return (
+        f"{VER} {error}\r\nContent-Type: {content_type}\r\nContent-Length: {length_bytes(data)}\r\n\r\n{data}"
+    ).encode()
+
+
+def insert_header(response: bytes, header: str) -> bytes:
+    """add a header line to an already built response, right before the blank line that ends the headers"""
+    end = response.find(b"\r\n\r\n")
+    return response[:end] + f"\r\n{header}".encode() + response[end:]
+
+
+def get_header(request: dict, name: str):
+    """value of the given header in the parsed request (case insensitive name), None if the client didn't send it"""
+    if request is None:
+        return None
+    return request["headers"].get(name.lower())
+
+
+def wants_keep_alive(request: dict) -> bool:
+    """HTTP/1.1 keeps the connection open unless told otherwise, HTTP/1.0 only when asked for"""
+    connection = (get_header(request, "Connection") or "").lower()
+    if request["line"].endswith("HTTP/1.0"):
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+def new_parser(file_path: str) -> dict:
+    """state of the request parser for one connection, see parse_request. file_path is the webroot, for uploads"""
+    return {
+        "buffer": bytearray(),  # bytes received but not parsed yet (may hold several pipelined requests)
+        "chunk": bytearray(RECV_SIZE),  # reusable buffer recv_into writes to
+        "scanned": 0,  # how far the buffer was already searched for the end of the headers (or chunk line, trailers)
+        "request": None,  # parsed head still waiting for its body
+        "root": file_path,
+        "interim": None,  # 100 Continue waiting to be sent, see start_upload
+    }
+
+
+def receive(client_socket, parser: dict) -> int:
+    """read what the socket has into the parser's buffer, returns how many bytes (0 when the client closed)"""
+    count = client_socket.recv_into(parser["chunk"])
+    parser["buffer"] += memoryview(parser["chunk"])[:count]
+    return count
+
+
+def parse_head(parser: dict):
+    """
+    take the request line and headers off the front of the buffer once the blank line after them arrived
+    only the head is decoded, and the buffer is searched from where the last search stopped
+    returns the request (see parse_request) or None if the head has not fully arrived yet
+    """
+    buffer = parser["buffer"]
+    end = buffer.find(b"\r\n\r\n", max(parser["scanned"] - 3, 0))  # the blank line may straddle two reads
+    if end == -1:
+        parser["scanned"] = len(buffer)
+        if len(buffer) >= MAX_HEADER_SIZE:
+            return {"error": "431 Request Header Fields Too Large"}
+        return None
+    if end + 4 > MAX_HEADER_SIZE:
+        return {"error": "431 Request Header Fields Too Large"}
+    lines = bytes(buffer[:end]).decode("latin-1").split("\r\n")  # header bytes are latin-1 by the RFC
+    del buffer[: end + 4]
+    parser["scanned"] = 0
+
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(":")
+        if not colon:
+            return {"error": "400 Bad Request"}
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value  # repeated headers are a list
+    request = {"error": None, "line": lines[0], "headers": headers, "body": b""}
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        request["chunked"] = True
+        request["length"] = 0  # size of the next chunk, once we read its size line
+    else:
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            return {"error": "400 Bad Request"}
+        request["chunked"] = False
+        request["length"] = int(length)
+    return request
+
+
+def parse_chunks(parser: dict, request: dict) -> bool:
+    """
+    take as many complete chunks of a chunked body off the buffer as there are
+    returns True once the last (zero size) chunk and the trailers were read
+    """
+    buffer = parser["buffer"]
+    body = request.setdefault("chunks", bytearray())
+    while True:
+        if request["length"] == 0:  # expecting a size line
+            end = buffer.find(b"\r\n", max(parser["scanned"] - 1, 0))  # the CRLF may straddle two reads
+            if end == -1:
+                parser["scanned"] = len(buffer)
+                if len(buffer) > MAX_CHUNK_LINE:
+                    request["error"] = "400 Bad Request"
+                    return True
+                return False
+            parser["scanned"] = 0
+            if end > MAX_CHUNK_LINE:
+                request["error"] = "400 Bad Request"
+                return True
+            size = bytes(buffer[:end]).split(b";")[0].strip()  # drop chunk extensions
+            try:
+                request["length"] = int(size, 16) + 2  # the data is followed by a CRLF
+            except ValueError:
+                request["error"] = "400 Bad Request"
+                return True
+            del buffer[: end + 2]
+            if request["length"] == 2:  # last chunk, skip the trailers up to the blank line
+                request["length"] = -1
+        if request["length"] == -1:
+            if buffer.startswith(b"\r\n"):
+                del buffer[:2]
+                request["body"] = bytes(body)
+                return True
+            end = buffer.find(b"\r\n\r\n", max(parser["scanned"] - 3, 0))
+            if end == -1:
+                parser["scanned"] = len(buffer)
+                if len(buffer) >= MAX_HEADER_SIZE:  # trailers are headers too
+                    request["error"] = "431 Request Header Fields Too Large"
+                    return True
+                return False
+            parser["scanned"] = 0
+            if end + 4 > MAX_HEADER_SIZE:
+                request["error"] = "431 Request Header Fields Too Large"
+                return True
+            del buffer[: end + 4]
+            request["body"] = bytes(body)
+            return True
+        if len(body) + request["length"] - 2 > MAX_BODY_SIZE:
+            request["error"] = "413 Payload Too Large"
+            return True
+        if len(buffer) < request["length"]:
+            return False
+        if buffer[request["length"] - 2: request["length"]] != b"\r\n":  # data longer than its size line said
+            request["error"] = "400 Bad Request"
+            return True
+        body += buffer[: request["length"] - 2]
+        del buffer[: request["length"]]
+        request["length"] = 0
+
+
+def parse_request(parser: dict):
+    """
+    incremental parser - call it after every read, it picks up where it stopped
+    returns None until a whole request (head and body) is in, then the request as a dict:
+    error (None, or the error status to answer with before closing), line (the request line), headers (lowercase
+    names), body (bytes, Content-Length or chunked), start (perf_counter when the head was in), and for uploads
+    upload (see start_upload) instead of the body
+    """
+    request = parser["request"] or parse_head(parser)
+    if request is None:
+        return None
+    if "start" not in request:  # head just came in
+        request["start"] = time.perf_counter()
+        if not request["error"] and upload_path(request["line"]) is not None:
+            start_upload(parser, request)
+    if request["error"]:
+        parser["interim"] = None
+        return request
+    parser["request"] = request  # head is in, waiting for the body
+    if "upload" in request:
+        if not write_upload(parser, request):
+            return None
+    elif request["chunked"]:
+        if not parse_chunks(parser, request):
+            return None
+    elif request["length"]:
+        if request["length"] > MAX_BODY_SIZE:
+            request["error"] = "413 Payload Too Large"
+        elif len(parser["buffer"]) < request["length"]:
+            return None
+        else:
+            request["body"] = bytes(parser["buffer"][: request["length"]])
+            del parser["buffer"][: request["length"]]
+    parser["request"] = None
+    parser["interim"] = None  # whole body is in, too late for a 100 Continue
+    return request
+
+
+def upload_path(line: str):
+    """the url path a request line uploads to (POST or PUT under UPLOAD_PREFIX), None if it is not an upload"""
+    parts = line.split(" ")
+    if len(parts) != 3 or parts[0] not in ("POST", "PUT") or not parts[1].startswith(UPLOAD_PREFIX):
+        return None
+    return parts[1].split("?")[0]  # as sent, GET paths aren't unquoted either
+
+
+def start_upload(parser: dict, request: dict):
+    """
+    check an upload before any of its body is read - it needs a Content-Length (411) no bigger than MAX_UPLOAD_SIZE
+    (413) and a file name inside UPLOAD_PREFIX (403) that needs no %-encoding (400). sets request["error"], or request["upload"] with the temp file
+    the body goes to
+    """
+    url = upload_path(request["line"])
+    folder = os.path.normpath(parser["root"] + UPLOAD_PREFIX)
+    target = os.path.normpath(parser["root"] + url)
+    if request["chunked"] or "content-length" not in request["headers"]:
+        request["error"] = "411 Length Required"
+    elif request["length"] > MAX_UPLOAD_SIZE:
+        request["error"] = "413 Payload Too Large"
+    elif urllib.parse.quote(url) != url:  # names that need %-encoding couldn't be fetched back with GET
+        request["error"] = "400 Bad Request"
+    elif (
+        not target.startswith(folder + os.sep)
+        or url.endswith("/")
+        or os.path.basename(target).startswith(UPLOAD_TEMP_PREFIX)
+    ):
+        request["error"] = "403 Forbidden"
+    if request["error"]:
+        return
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # same folder as the target, so moving it into place is a rename
+        handle, temp = tempfile.mkstemp(prefix=UPLOAD_TEMP_PREFIX, dir=os.path.dirname(target))
+    except OSError as e:
+        print("Upload error: ", e)
+        request["error"] = "500 Internal Server Error"
+        return
+    request["upload"] = {
+        "url": url,
+        "target": target,
+        "temp": temp,
+        "file": os.fdopen(handle, "wb"),
+        "left": request["length"],  # body bytes still to come
+    }
+    if (
+        "100-continue" in request["headers"].get("expect", "").lower()
+        and len(parser["buffer"]) < request["length"]
+    ):  # the body didn't come with the head, the client may be waiting for us
+        parser["interim"] = CONTINUE
+
+
+def write_upload(parser: dict, request: dict) -> bool:
+    """move the body bytes we have from the buffer to the upload's temp file, returns True once the whole body is in"""
+    upload = request["upload"]
+    buffer = parser["buffer"]
+    count = min(len(buffer), upload["left"])
+    try:
+        if count:
+            upload["file"].write(memoryview(buffer)[:count])
+            del buffer[:count]
+            upload["left"] -= count
+        if upload["left"]:
+            return False
+        upload["file"].flush()
+        os.fsync(upload["file"].fileno())  # on disk before it replaces anything
+        upload["file"].close()
+    except OSError as e:  # disk full and such, answer with an error and close
+        print("Upload error: ", e)
+        discard_upload(parser)
+        request["error"] = "500 Internal Server Error"
+    return True
+
+
+def discard_upload(parser: dict):
+    """the connection closed in the middle of an upload, remove its temp file"""
+    request = parser["request"]
+    if request is None or "upload" not in request:
+        return
+    request["upload"]["file"].close()
+    try:
+        os.remove(request["upload"]["temp"])
+    except OSError:
+        pass
+
+
+def finish_upload(request: dict) -> bytes:
+    """move a fully received upload into place (atomic rename) and update the manifest, returns the response"""
+    upload = request["upload"]
+    existed = os.path.exists(upload["target"])
+    try:
+        os.chmod(upload["temp"], UPLOAD_MODE)
+        os.replace(upload["temp"], upload["target"])
+    except OSError as e:
+        print("Upload error: ", e)
+        os.remove(upload["temp"])
+        return error_response("500 Internal Server Error")
+    info = file_stat(upload["target"])
+    if info is not None:  # served right away, no need to wait for the next manifest refresh
+        MANIFEST[upload["url"]] = manifest_entry(upload["target"], info)
+    if existed:
+        return f"{VER} 204 No Content\r\n\r\n".encode()
+    return f"{VER} 201 Created\r\nLocation: {upload['url']}\r\nContent-Length: 0\r\n\r\n".encode()
+
+
+def create_keep_alive_response(
+        request: dict,
+        file_path: str,
+        served: int,
+        max_requests: int = MAX_KEEP_ALIVE_REQUESTS):
+    """
+    build the response for a request on a persistent connection, served is how many requests (this one included) the
+    connection has had. returns the response with a Connection header, and whether to keep the connection open after it
+    """
+    if request["error"]:  # the parser gave up on it, answer and close
+        if VERBOSE:
+            print(f"Error: {request['error']}")
+        return [insert_header(error_response(request["error"]), "Connection: close")], False
+    parts, keep_alive = create_client_response(request, file_path)
+    parts = finish_stream(parts, request)
+    keep_alive = keep_alive and served < max_requests
+    if keep_alive:  # the headers are always in the first part
+        parts[0] = insert_header(
+            parts[0], f"Connection: keep-alive\r\nKeep-Alive: timeout={KEEP_ALIVE_TIMEOUT}, max={max_requests}")
+    else:
+        parts[0] = insert_header(parts[0], "Connection: close")
+    return parts, keep_alive
+
+
+def access_record(request: dict, parts: list, ip) -> dict:
+    """
+    what the access log and the metrics need to know about a request, taken from its response before it goes out.
+    only raw values, the log thread does the formatting (see format_record), finish_request adds the duration.
+    a generated body is swapped for one that counts its bytes as they are sent
+    """
+    record = {
+        "start": request["start"],
+        "ip": ip,
+        "line": request.get("line", "-"),  # requests the parser gave up on have no line
+        "status": parts[0][9:12],  # the headers are always in the first part, right after "HTTP/1.1 "
+        "bytes": 0,
+    }
+    for i, part in enumerate(parts):
+        if isinstance(part, tuple):
+            record["bytes"] += part[2]
+        elif isinstance(part, collections.abc.Iterator):
+            parts[i] = count_stream(part, record)
+        else:
+            record["bytes"] += len(part)
+    return record
+
+
+def count_stream(stream, record: dict):
+    """generator - pass a generated body through, adding what it sends to the access record"""
+    for data in stream:
+        record["bytes"] += len(data)
+        yield data
+
+
+def finish_request(record: dict):
+    """
+    the whole response was sent - count it in the metrics and hand the record to the log thread (never waits, drops it
+    if the log is behind)
+    """
+    record["duration"] = time.perf_counter() - record["start"]
+    if METRICS:
+        record_metrics(record)
+    if not ACCESS_LOG:
+        return
+    record["time"] = time.time()
+    try:
+        LOG_QUEUE.put_nowait(record)
+    except queue.Full:
+        LOG_STATS["dropped"] += 1
+
+
+def format_record(record: dict) -> str:
+    """access log line, common log format with the duration added"""
+    ip = record["ip"][0] if isinstance(record["ip"], tuple) else record["ip"]
+    date = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(record["time"]))
+    return (
+        f'{ip} - - [{date}] "{record["line"]}" {record["status"].decode("latin-1")} {record["bytes"]} '
+        f'{record["duration"] * 1000:.3f}ms'
+    )
+
+
+def access_logger(log_file):
+    """
+    log thread - wait for a record, collect more for up to LOG_FLUSH_INTERVAL (or LOG_BATCH of them), then format
+    and write them all with one write and one flush
+    """
+    while True:
+        records = [LOG_QUEUE.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(records) < LOG_BATCH:
+            try:
+                records.append(LOG_QUEUE.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        try:
+            log_file.write("".join(format_record(record) + "\n" for record in records))
+            log_file.flush()
+            LOG_STATS["written"] += len(records)
+        except Exception as e:
+            print("Log error: ", e)
+
+
+def start_access_log():
+    """start the log thread, if ACCESS_LOG is on"""
+    if not ACCESS_LOG:
+        return
+    log_file = sys.stdout if ACCESS_LOG_FILE is None else open(ACCESS_LOG_FILE, "a")
+    threading.Thread(
+        target=access_logger, args=(log_file,), name="access-log", daemon=True
+    ).start()
+    print(f"Access log: {ACCESS_LOG_FILE or 'stdout'}")
+
+
+def request_route(line: str) -> str:
+    """
+    route a request is counted under - the page for METRIC_ROUTES, otherwise its kind (static, redirect or other), so
+    the number of routes stays fixed whatever urls clients make up
+    """
+    parts = line.split(" ")
+    if len(parts) != 3:
+        return "other"
+    page = parts[1].split("?")[0]
+    if page in METRIC_ROUTES:
+        return page
+    if page in REDIRECTS:
+        return "redirect"
+    if page in INDEX_URLS or page in MANIFEST:
+        return "static"
+    return "other"
+
+
+def record_metrics(record: dict):
+    """count a finished request (see access_record) in METRICS_STATS"""
+    route = request_route(record["line"])
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, record["duration"])
+    with METRICS_LOCK:
+        statuses = METRICS_STATS["statuses"]
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+        METRICS_STATS["bytes"] += record["bytes"]
+        latency = METRICS_STATS["routes"].get(route)
+        if latency is None:
+            latency = METRICS_STATS["routes"][route] = {
+                "count": 0, "sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+        latency["count"] += 1
+        latency["sum"] += record["duration"]
+        latency["buckets"][bucket] += 1
+
+
+def count_dropped(reason: str):
+    """a client was turned away ("rejected") or dropped mid request ("timeouts")"""
+    with METRICS_LOCK:
+        METRICS_STATS[reason] += 1
+
+
+def count_connection(opened: bool):
+    """a client connection was opened or closed"""
+    with METRICS_LOCK:
+        if opened:
+            METRICS_STATS["connections"] += 1
+            METRICS_STATS["accepted"] += 1
+        else:
+            METRICS_STATS["connections"] -= 1
+
+
+def metrics_response() -> bytes:
+    """the METRICS_URL page - counters, latency histograms, cache and queue gauges in the prometheus text format"""
+    with METRICS_LOCK:  # copy, so the formatting happens outside the lock
+        statuses = dict(METRICS_STATS["statuses"])
+        routes = {route: dict(latency, buckets=list(latency["buckets"]))
+                  for route, latency in METRICS_STATS["routes"].items()}
+        sent = METRICS_STATS["bytes"]
+        connections = METRICS_STATS["connections"]
+        accepted = METRICS_STATS["accepted"]
+        rejected = METRICS_STATS["rejected"]
+        timeouts = METRICS_STATS["timeouts"]
+    cache = cache_stats()
+
+    lines = ["# TYPE http_requests_total counter"]
+    for status, count in sorted(statuses.items()):
+        lines.append(f'http_requests_total{{status="{status.decode("latin-1")}"}} {count}')
+    lines += ["# TYPE http_response_bytes_total counter", f"http_response_bytes_total {sent}"]
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for route, latency in sorted(routes.items()):
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), latency["buckets"]):
+            total += count  # prometheus buckets are cumulative
+            lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {total}')
+        lines.append(f'http_request_duration_seconds_sum{{route="{route}"}} {latency["sum"]:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{route="{route}"}} {latency["count"]}')
+    lines += [
+        "# TYPE http_connections_open gauge", f"http_connections_open {connections}",
+        "# TYPE http_connections_accepted_total counter", f"http_connections_accepted_total {accepted}",
+        "# TYPE http_connections_rejected_total counter", f"http_connections_rejected_total {rejected}",
+        "# TYPE http_request_head_timeouts_total counter", f"http_request_head_timeouts_total {timeouts}",
+        "# TYPE http_accept_queue_depth gauge", f"http_accept_queue_depth {queue_depth()}",
+        "# TYPE http_cache_hits_total counter", f"http_cache_hits_total {cache['hits']}",
+        "# TYPE http_cache_misses_total counter", f"http_cache_misses_total {cache['misses']}",
+        "# TYPE http_cache_evictions_total counter", f"http_cache_evictions_total {cache['evictions']}",
+        "# TYPE http_cache_hit_ratio gauge", f"http_cache_hit_ratio {cache['hit_rate']:.4f}",
+        "# TYPE http_cache_bytes gauge", f"http_cache_bytes {cache['bytes']}",
+        "# TYPE http_cache_files gauge", f"http_cache_files {cache['files']}",
+        "# TYPE http_access_log_dropped_total counter", f"http_access_log_dropped_total {LOG_STATS['dropped']}",
+    ]
+    body = "\n".join(lines) + "\n"
+    return (
+        f"{VER} 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nCache-Control: no-store\r\n"
+        f"Content-Length: {length_bytes(body)}\r\n\r\n{body}"
+    ).encode()
+
+
+def send_buffers(client_socket, buffers: list):
+    """
+    send a run of byte buffers in order, with one sendmsg (scatter/gather) where the OS has it so they don't get
+    joined (copied) first. handles partial writes, like sendall
+    """
+    if not hasattr(client_socket, "sendmsg"):  # windows
+        client_socket.sendall(b"".join(buffers))
+        return
+    views = collections.deque(memoryview(buffer) for buffer in buffers if buffer)
+    while views:
+        trim_sent(views, client_socket.sendmsg(views))
+
+
+def trim_sent(views: collections.deque, sent: int):
+    """drop sent bytes from the front of a queue of memoryviews"""
+    while sent and sent >= len(views[0]):
+        sent -= len(views.popleft())
+    if sent:
+        views[0] = views[0][sent:]
+
+
+def send_parts(client_socket, parts: list):
+    """
+    send a response (list of parts, see create_response) on a blocking socket, files go out with sendfile and
+    generated bodies one chunk at a time, as they are made
+    """
+    buffers = []  # bytes parts waiting to go out together
+    for part in parts:
+        if isinstance(part, collections.abc.Iterator):  # generated body (see finish_stream)
+            send_buffers(client_socket, buffers)
+            buffers = []
+            for data in part:
+                client_socket.sendall(data)
+        elif isinstance(part, tuple):  # piece of a file
+            send_buffers(client_socket, buffers)
+            buffers = []
+            filename, offset, count = part
+            with open(filename, "rb") as file:
+                # zero copy (os.sendfile) where the OS has it, loops over short writes for us
+                sent = client_socket.sendfile(file, offset, count)
+            if sent < count:  # the file got shorter than the Content-Length we promised
+                raise OSError(f"{filename} ended early")
+        else:
+            buffers.append(part)
+    send_buffers(client_socket, buffers)
 
 
 def validate_http_request(request: str):
@@ -311,51 +1539,129 @@ def validate_http_request(request: str):
     return True, resource, method  # return success, resource, and method
 
 
-def handle_client(client_socket, file_path: str):
+def create_client_response(request: dict, file_path: str):
+    """
+    Verify the client's request is legal HTTP and build the response for it (shared by every serving mode)
+    returns the response and whether the connection may stay open after it
+    """
+    valid_http, resource, method = validate_http_request(request["line"])
+    if valid_http:
+        if VERBOSE:
+            print("Got a valid HTTP request")
+        if method == "GET":  # only handling GET requests
+            return create_response(resource, file_path, request), wants_keep_alive(request)
+        elif "upload" in request:  # POST or PUT under UPLOAD_PREFIX, the body is already in its temp file
+            return [finish_upload(request)], wants_keep_alive(request)
+        elif method == "POST" and resource.split("?")[0] in BATCH_URLS:  # batch questions in the body
+            page, _, query = resource.partition("?")
+            return batch_response(
+                page, query, request["body"], request["headers"].get("content-type", "")
+            ), wants_keep_alive(request)
+        elif method in (
+            "POST",
+            "HEAD",
+            "PUT",
+            "DELETE",
+            "OPTIONS",
+            "TRACE",
+            "CONNECT",
+            "PATCH",
+        ):  # all other http methods are not implemented (501 Not Implemented
+            if VERBOSE:
+                print(f"Got a {method} request, we don't need to handle these")
+            # the parser already took the body off the connection, so it can be reused
+            return [error_response("501 Not Implemented")], wants_keep_alive(request)
+        elif VERBOSE:  # the access log already has the 500
+            print("Error: Not a valid HTTP request method")
+    elif VERBOSE:
+        print("Error: Not a valid HTTP request")
+    return [error_response("500 Internal Server Error")], False  # default error response
+
+
+def handle_client(
+        client_socket,
+        file_path: str,
+        max_requests: int = MAX_KEEP_ALIVE_REQUESTS):
     """Handles client requests: verifies client"s requests are legal HTTP, calls function to handle the requests"""
-    print("Client connected")
+    if VERBOSE:
+        print("Client connected")
 
-    # default error response
-    invalid = error_response("500 Internal Server Error")
+    parser = new_parser(file_path)  # may hold several pipelined requests
+    served = 0  # requests handled on this connection
+    count_connection(True)
+    timeout = SOCKET_TIMEOUT  # idle time allowed, KEEP_ALIVE_TIMEOUT after the first request
+    deadline = time.monotonic() + HEADER_TIMEOUT  # for the next request head to be in
     try:
+        ip = client_socket.getpeername() if ACCESS_LOG else None
         while True:
-            client_request = client_socket.recv(MAX_LENGTH).decode()
-            valid_http, resource, method = validate_http_request(
-                client_request)
-            if valid_http:
-                print("Got a valid HTTP request")
-                if method == "GET":  # only handling GET requests
-                    handle_client_request(resource, client_socket, file_path)
-                elif method in (
-                    "POST",
-                    "HEAD",
-                    "PUT",
-                    "DELETE",
-                    "OPTIONS",
-                    "TRACE",
-                    "CONNECT",
-                    "PATCH",
-                ):  # all http methods (except GET) are not implemented (501 Not Implemented
-                    print(
-                        f"Got a {method} request, we don't need to handle these")
-                    client_socket.send(error_response("501 Not Implemented"))
+            request = parse_request(parser)
+            if request is None:  # need more bytes for a full request
+                if parser["request"] is None:  # still waiting for the head, every read counts against the deadline
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        head_timeout(client_socket, parser)
+                        break
+                    client_socket.settimeout(min(timeout, left))
                 else:
-                    print("Error: Not a valid HTTP request method")
-                    client_socket.send(invalid)
-                break  # any request handled will break the loop
-            else:
-                print("Error: Not a valid HTTP request")
-                client_socket.send(invalid)
+                    client_socket.settimeout(timeout)
+                    if parser["interim"]:  # the client waits for a go ahead before sending the body
+                        client_socket.sendall(parser["interim"])
+                        parser["interim"] = None
+                if not receive(client_socket, parser):  # client closed the connection
+                    break
+                continue
+
+            served += 1
+            parts, keep_alive = create_keep_alive_response(
+                request, file_path, served, max_requests)
+            record = access_record(request, parts, ip) if ACCESS_LOG or METRICS else None
+            send_parts(client_socket, parts)
+            if record is not None:
+                finish_request(record)
+            if not keep_alive:
                 break
+            timeout = KEEP_ALIVE_TIMEOUT  # idle time allowed until the next request
+            deadline = time.monotonic() + HEADER_TIMEOUT
     except socket.timeout:
-        print("Socket timed out")
+        if VERBOSE:
+            print("Socket timed out")
+        head_timeout(client_socket, parser)
     except Exception as e:
         print("Error: ", e)
     finally:
-        print("Closing connection")
+        if VERBOSE:
+            print("Closing connection")
+        count_connection(False)
+        discard_upload(parser)
         client_socket.close()
 
 
+def send_now(client_socket, response: bytes):
+    """best effort send of a short response to a client we are about to drop, never waits"""
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(response)
+    except OSError:
+        pass
+
+
+def head_timeout(client_socket, parser: dict):
+    """
+    a client took too long - 408 if it was in the middle of a request head (slowloris), idle keep-alive clients are just
+    closed. the caller closes the socket
+    """
+    if parser["buffer"] and parser["request"] is None:
+        count_dropped("timeouts")
+        send_now(client_socket, insert_header(error_response("408 Request Timeout"), "Connection: close"))
+
+
+def reject_client(client_socket):
+    """turn a client away with a 503 (we are over MAX_CONNECTIONS or the accept queue is full) and close it"""
+    count_dropped("rejected")
+    send_now(client_socket, OVERLOAD)
+    client_socket.close()
+
+
 def meta_code() -> str:
     """
     Code to easily ensure that the script has access to webroot - not really required as part of course...
@@ -380,23 +1686,423 @@ def meta_code() -> str:
     return file_path  # I expect the user to point the code to the right directory, this function is just to try to make it easier
 
 
+def queue_depth() -> int:
+    """how many accepted clients are currently waiting for a free worker"""
+    return CLIENT_QUEUE.qsize()
+
+
+def worker(file_path: str):
+    """Worker thread loop - take accepted clients off the queue and serve them, forever"""
+    while True:
+        client_socket = CLIENT_QUEUE.get()  # blocks until there is a client
+        try:
+            handle_client(client_socket, file_path)
+        finally:
+            CLIENT_QUEUE.task_done()
+
+
+def start_workers(file_path: str, count: int):
+    """Start the worker pool, threads are daemons so ctrl+c still stops the server"""
+    for i in range(count):
+        threading.Thread(
+            target=worker, args=(file_path,), name=f"worker-{i}", daemon=True
+        ).start()
+    print(f"Started {count} worker threads (accept queue size {ACCEPT_QUEUE_SIZE})")
+
+
+def serve_serial(server_socket, file_path: str):
+    """Original mode - accept a client and serve it before accepting the next one"""
+    while True:
+        client_socket, client_ip = server_socket.accept()
+        if VERBOSE:
+            print(f"New connection received: {client_ip}")
+        client_socket.settimeout(SOCKET_TIMEOUT)
+        # one request per connection, an idle keep-alive client would hold up everyone else here
+        handle_client(client_socket, file_path, max_requests=1)
+
+
+def serve_threads(server_socket, file_path: str, workers: int):
+    """Accept clients and hand them to the worker pool, so many clients are served at once"""
+    start_workers(file_path, workers)
+    while True:
+        client_socket, client_ip = server_socket.accept()
+        if METRICS_STATS["connections"] + queue_depth() >= MAX_CONNECTIONS:
+            reject_client(client_socket)
+            continue
+        client_socket.settimeout(SOCKET_TIMEOUT)
+        try:
+            # every worker is busy and the queue is full, waiting in line would only make latency worse
+            CLIENT_QUEUE.put_nowait(client_socket)
+        except queue.Full:
+            reject_client(client_socket)
+            continue
+        if VERBOSE:
+            print(f"New connection received: {client_ip} (queue depth {queue_depth()})")
+
+
+def close_connection(selector, connections: dict, conn: dict):
+    """events mode - forget the client and close its socket"""
+    client_socket = conn["socket"]
+    selector.unregister(client_socket)
+    connections.pop(client_socket, None)
+    for part in conn["out"]:
+        if isinstance(part, dict) and "file" in part:  # file we were in the middle of sending
+            part["file"].close()
+    client_socket.close()
+    count_connection(False)
+    discard_upload(conn["parser"])
+    if VERBOSE:
+        print(f"Closing connection {conn['ip']}")
+
+
+def accept_event(server_socket, selector, connections: dict, file_path: str):
+    """events mode - accept every waiting client without blocking and start reading from it"""
+    while True:
+        try:
+            client_socket, client_ip = server_socket.accept()
+        except BlockingIOError:
+            return  # no more clients waiting
+        if len(connections) >= MAX_CONNECTIONS:
+            reject_client(client_socket)
+            continue
+        if VERBOSE:
+            print(f"New connection received: {client_ip}")
+        client_socket.setblocking(False)
+        conn = {
+            "socket": client_socket,
+            "ip": client_ip,
+            "parser": new_parser(file_path),  # request bytes received but not handled yet
+            "out": collections.deque(),  # response parts waiting to be sent (see queue_parts), and access log records
+            "served": 0,  # requests handled on this connection
+            "close": False,  # close once the responses are out (no keep-alive)
+            "timeout": SOCKET_TIMEOUT,  # idle time allowed, KEEP_ALIVE_TIMEOUT after the first request
+            "last": time.monotonic(),  # last activity, for the idle timeout
+            "deadline": time.monotonic() + HEADER_TIMEOUT,  # for the next request head to be in
+        }
+        connections[client_socket] = conn
+        count_connection(True)
+        selector.register(client_socket, selectors.EVENT_READ, conn)
+
+
+def handle_buffered(conn: dict, file_path: str):
+    """events mode - answer every complete request in the buffer (pipelined requests are answered in order)"""
+    while not conn["close"]:
+        request = parse_request(conn["parser"])
+        if request is None:  # need more bytes for a full request
+            if conn["parser"]["interim"]:  # the client waits for a go ahead before sending the body
+                queue_parts(conn["out"], [conn["parser"]["interim"]])
+                conn["parser"]["interim"] = None
+            return
+        conn["served"] += 1
+        try:
+            parts, keep_alive = create_keep_alive_response(
+                request, file_path, conn["served"])
+        except Exception as e:
+            print("Error: ", e)
+            parts = [insert_header(
+                error_response("500 Internal Server Error"), "Connection: close")]
+            keep_alive = False
+        record = access_record(request, parts, conn["ip"]) if ACCESS_LOG or METRICS else None
+        queue_parts(conn["out"], parts)
+        if record is not None:  # logged and counted once the response before it is out, see finish_sent
+            conn["out"].append(record)
+        conn["close"] = not keep_alive
+        conn["timeout"] = KEEP_ALIVE_TIMEOUT
+
+
+def queue_parts(out: collections.deque, parts: list):
+    """events mode - add a response to the outgoing queue, bytes become memoryviews so partial sends don't copy"""
+    for part in parts:
+        if isinstance(part, (tuple, collections.abc.Iterator)):  # piece of a file or generated body, dealt with later
+            out.append(part)
+        elif part:
+            out.append(memoryview(part))
+
+
+def send_file_chunk(client_socket, part: dict) -> int:
+    """events mode - send the next piece of a file without blocking, zero copy with os.sendfile where the OS has it"""
+    count = min(part["left"], SENDFILE_CHUNK)
+    if hasattr(os, "sendfile"):
+        sent = os.sendfile(
+            client_socket.fileno(), part["file"].fileno(), part["offset"], count)
+    else:  # read the chunk ourselves, still at most SENDFILE_CHUNK in memory
+        part["file"].seek(part["offset"])
+        sent = client_socket.send(part["file"].read(count))
+    if sent == 0:  # the file got shorter than the Content-Length we promised
+        raise OSError(f"{part['file'].name} ended early")
+    part["offset"] += sent
+    part["left"] -= sent
+    return sent
+
+
+def send_some(client_socket, out: collections.deque):
+    """
+    events mode - send from the front of the outgoing queue without blocking (raises BlockingIOError when the socket
+    buffer is full). memoryviews in a row go out in one sendmsg, file pieces with send_file_chunk, generated bodies
+    make their next chunk only when we got to them
+    """
+    part = out[0]
+    if isinstance(part, collections.abc.Iterator):
+        try:
+            data = next(part, None)
+        except Exception as e:  # the headers are out, all we can do is cut the response short
+            raise OSError(f"Generated response failed: {e}")
+        if data is None:  # all of it was sent
+            out.popleft()
+            finish_sent(out)
+            return
+        part = memoryview(data)
+        out.appendleft(part)
+    if isinstance(part, tuple):  # file piece we just got to, open it now
+        filename, offset, count = part
+        part = out[0] = {"file": open(filename, "rb"), "offset": offset, "left": count}
+    if isinstance(part, dict):
+        send_file_chunk(client_socket, part)
+        if part["left"] == 0:  # whole piece sent
+            part["file"].close()
+            out.popleft()
+            finish_sent(out)
+        return
+
+    views = []
+    for part in out:
+        if not isinstance(part, memoryview):
+            break
+        views.append(part)
+    if hasattr(client_socket, "sendmsg"):
+        trim_sent(out, client_socket.sendmsg(views))
+    else:  # windows
+        trim_sent(out, client_socket.send(views[0]))
+    finish_sent(out)
+
+
+def finish_sent(out: collections.deque):
+    """events mode - access log records at the front of the outgoing queue belong to responses that are fully sent"""
+    while out and isinstance(out[0], dict) and "file" not in out[0]:
+        finish_request(out.popleft())
+
+
+def read_event(selector, connections: dict, conn: dict, file_path: str):
+    """events mode - read whatever the client sent, once requests are complete build the responses"""
+    try:
+        count = receive(conn["socket"], conn["parser"])
+    except BlockingIOError:
+        return  # spurious wakeup, nothing to read yet
+    except OSError as e:
+        print("Error: ", e)
+        close_connection(selector, connections, conn)
+        return
+    if not count:  # client closed the connection
+        close_connection(selector, connections, conn)
+        return
+
+    conn["last"] = time.monotonic()
+    handle_buffered(conn, file_path)
+    if conn["out"]:  # stop reading until the responses are out (back pressure on pipelining clients)
+        selector.modify(conn["socket"], selectors.EVENT_WRITE, conn)
+
+
+def write_event(selector, connections: dict, conn: dict, file_path: str):
+    """events mode - send as much as the socket takes, then go back to reading (or close without keep-alive)"""
+    try:
+        send_some(conn["socket"], conn["out"])
+    except BlockingIOError:
+        return  # socket buffer is full, try again on the next event
+    except OSError as e:
+        print("Error: ", e)
+        close_connection(selector, connections, conn)
+        return
+    conn["last"] = time.monotonic()
+    if conn["out"]:
+        return  # more to send
+    if conn["close"]:
+        close_connection(selector, connections, conn)
+        return
+    conn["deadline"] = conn["last"] + HEADER_TIMEOUT  # responses are out, the clock starts for the next request
+    handle_buffered(conn, file_path)  # requests that were pipelined while we were writing
+    if not conn["out"]:
+        selector.modify(conn["socket"], selectors.EVENT_READ, conn)
+
+
+def drop_idle(selector, connections: dict):
+    """
+    events mode - close clients that did nothing for their timeout (SOCKET_TIMEOUT or KEEP_ALIVE_TIMEOUT), or are
+    waiting on a request head that is not in by its deadline (HEADER_TIMEOUT)
+    """
+    now = time.monotonic()
+    for conn in list(connections.values()):  # copy, closing changes the dict
+        waiting = not conn["out"] and conn["parser"]["request"] is None  # for a request head
+        if now - conn["last"] > conn["timeout"] or (waiting and now > conn["deadline"]):
+            if VERBOSE:
+                print(f"Socket timed out {conn['ip']}")
+            if waiting:
+                head_timeout(conn["socket"], conn["parser"])
+            close_connection(selector, connections, conn)
+
+
+def serve_events(server_socket, file_path: str):
+    """
+    Single thread, non-blocking sockets and a selectors loop (epoll/kqueue/select, whatever the OS has best)
+    idle or slow clients cost a dict entry instead of a blocked thread
+    """
+    selector = selectors.DefaultSelector()
+    connections = {}  # client socket -> connection state
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ, None)  # no data marks the listening socket
+    last_sweep = time.monotonic()
+    while True:
+        for key, mask in selector.select(timeout=SELECT_INTERVAL):
+            conn = key.data
+            if conn is None:  # someone wants to connect
+                accept_event(server_socket, selector, connections, file_path)
+            elif mask & selectors.EVENT_READ:
+                read_event(selector, connections, conn, file_path)
+            elif mask & selectors.EVENT_WRITE:
+                write_event(selector, connections, conn, file_path)
+        if time.monotonic() - last_sweep >= SELECT_INTERVAL:
+            drop_idle(selector, connections)
+            last_sweep = time.monotonic()
+
+
+def listen_socket(reuse_port: bool = False):
+    """the listening socket on IP:PORT, reuse_port lets every prefork worker process listen on the same port"""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:  # the kernel spreads new connections between the processes
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((IP, PORT))
+    server_socket.listen()
+    return server_socket
+
+
+def worker_process(file_path: str):
+    """
+    prefork worker process - its own listening socket, file cache and threads (the manifest watcher and access log
+    thread, the parent runs neither), then serve with PREFORK_ENGINE. never returns
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # the parent's handler is inherited
+    try:
+        server_socket = listen_socket(reuse_port=True)
+    except OSError as e:
+        print(f"Worker {os.getpid()} can't listen on port {PORT}: {e}")
+        os._exit(BIND_FAILED)
+    start_manifest_watcher(file_path)
+    start_access_log()
+    try:
+        if PREFORK_ENGINE == "threads":
+            serve_threads(server_socket, file_path, WORKER_COUNT)
+        else:
+            serve_events(server_socket, file_path)
+    except KeyboardInterrupt:  # ctrl+c reaches every process in the group, the parent restarts no one
+        os._exit(0)
+    except Exception as e:
+        print(f"Worker {os.getpid()} error: ", e)
+    os._exit(1)
+
+
+def spawn_worker(file_path: str) -> int:
+    """fork a worker process, returns its pid"""
+    sys.stdout.flush()  # or the child prints the parent's buffered output again
+    pid = os.fork()
+    if pid == 0:
+        worker_process(file_path)
+    return pid
+
+
+def stop_server(signum, frame):
+    """SIGTERM handler of the prefork parent, stop the same way ctrl+c does"""
+    raise KeyboardInterrupt
+
+
+def serve_prefork(file_path: str, processes: int):
+    """
+    Start worker processes that all accept on PORT (SO_REUSEPORT) and restart any that die, so one crash doesn't
+    take the server down. every worker has its own cache and counters (/metrics shows the one that answered)
+    """
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        print("prefork mode needs os.fork and SO_REUSEPORT (linux, bsd or mac), try threads or events mode")
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, stop_server)
+    workers = {}  # pid -> worker number
+    failed = False
+    for number in range(processes):
+        workers[spawn_worker(file_path)] = number
+    print(f"Started {processes} worker processes ({PREFORK_ENGINE} mode each)")
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid not in workers:
+                continue
+            number = workers.pop(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if code == BIND_FAILED:
+                print(f"Worker {number} could not listen, stopping")
+                failed = True
+                break
+            print(f"Worker {number} (pid {pid}) exited with {code}, restarting it")
+            time.sleep(RESTART_DELAY)
+            workers[spawn_worker(file_path)] = number
+    except KeyboardInterrupt:
+        print("Stopping worker processes")
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:  # already gone
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    if failed:
+        sys.exit(1)
+
+
+def parse_args():
+    """
+    optional command line args: server.py [serial|threads|events|prefork] [worker count]
+    the count is of worker threads (threads mode) or processes (prefork mode), falls back to SERVE_MODE and
+    WORKER_COUNT or PROCESS_COUNT
+    """
+    args = sys.argv
+    mode = SERVE_MODE
+    workers = None
+    if len(args) > 1:
+        mode = args[1].lower()
+        if mode not in SERVE_MODES:
+            print(f"Unknown mode {mode}, choose one of: {', '.join(SERVE_MODES)}")
+            sys.exit(1)
+    if len(args) > 2:
+        worked, workers = to_int(args[2])
+        if not worked or workers < 1:
+            print("Worker count should be a positive number")
+            sys.exit(1)
+    return mode, workers
+
+
 def main():
+    mode, workers = parse_args()
 
     # can replace meta_code call with the absolute path to the webroot folder
     # instead - # ie hw5\webroot or C:\Networking\webroot
     file_path = meta_code()
+    # look at every file once, instead of on every request
+    build_manifest(file_path, watch=mode != "prefork")
+    if mode == "prefork":  # every worker process listens (and logs) on its own
+        print(f"Listening for connections on port {PORT} ({mode} mode)")
+        serve_prefork(file_path, workers or PROCESS_COUNT)
+        return
+    start_access_log()
 
     # regular server stuff
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((IP, PORT))
-    server_socket.listen()
-    print(f"Listening for connections on port {PORT}")
+    server_socket = listen_socket()
+    print(f"Listening for connections on port {PORT} ({mode} mode)")
     try:
-        while True:
-            client_socket, client_ip = server_socket.accept()
-            print(f"New connection received: {client_ip}")
-            client_socket.settimeout(SOCKET_TIMEOUT)
-            handle_client(client_socket, file_path)
+        if mode == "threads":
+            serve_threads(server_socket, file_path, workers or WORKER_COUNT)
+        elif mode == "events":
+            serve_events(server_socket, file_path)
+        else:
+            serve_serial(server_socket, file_path)
     except Exception as e:
         print("MError: ", e)
         server_socket.close()
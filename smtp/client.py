@@ -1,9 +1,15 @@
 import base64
+import os
+import pathlib
 import socket
+import sys
+import threading
 import time
 
 import SMTP_protocol
 
+VERBOSE = True  # print every step and server reply, bulk mode turns it off
+
 # email configurations
 
 # Add the minimum required fields to the email (i added more stuff for fun
@@ -13,13 +19,19 @@ INNER_MSG = (
 )  # repeat this x times
 EMAIL_TEXT = (
     f"From: {SMTP_protocol.USER}@{SMTP_protocol.DOMAIN}\r\n"
-    f"To: {SMTP_protocol.RCPT}@{SMTP_protocol.DOMAIN}\r\n"
+    f"To: {SMTP_protocol.RECIPIENT}@{SMTP_protocol.DOMAIN}\r\n"
     "Subject: Test Email\r\n"
     "\r\n" + INNER_MSG  # the actual stuff we care for
 )
 
 
 # helper functions to avoid repetition
+def log(msg):
+    """progress print, only when VERBOSE (errors are always printed)"""
+    if VERBOSE:
+        print(msg)
+
+
 def decode_b64(message):
     return (
         base64.b64decode(message).decode()
@@ -76,10 +88,8 @@ def create_DATA():
     return SMTP_protocol.DATA.encode()
 
 
-def create_CONTENT(msg):
-    return (
-        f"{msg}{SMTP_protocol.EMAIL_END}".encode()
-    )  # append end of email here, ... user can't forget
+def create_RSET():
+    return SMTP_protocol.RSET.encode()
 
 
 def create_QUIT():
@@ -101,46 +111,242 @@ def auth_input(response):
 def init_session():
     """Connect to server - Session Initiation"""
     my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # ip and tcp
+    my_socket.settimeout(SMTP_protocol.CLIENT_TIMEOUT)  # never wait on a stalled server forever
     try:
         my_socket.connect(
             (SMTP_protocol.SERVER_ADDRESS, SMTP_protocol.PORT)
         )  # send tuple to connect to  (server port)
-        print(f"Client connected to server successfully")
+        log(f"Client connected to server successfully")
         return my_socket
     except socket.error as er:  # captures errors on initial connect
         quit(my_socket, f"{er} from client to server ", False)
         return None  # nada, we are done
 
 
-def get_from_serv(my_socket):
-    msg = my_socket.recv(SMTP_protocol.MSG_SIZE).decode()
-    print(msg)  # helper function to save on lines of code
+def new_reader(my_socket):
+    """buffered reader for the server's replies - with PIPELINING several come back in one recv"""
+    return {"socket": my_socket, "buffer": bytearray()}
+
+
+def get_line(reader):
+    """next line from the server, CRLF included"""
+    buffer = reader["buffer"]
+    while b"\r\n" not in buffer:
+        data = reader["socket"].recv(SMTP_protocol.MSG_SIZE)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        buffer += data
+    end = buffer.find(b"\r\n") + 2
+    line = bytes(buffer[:end])
+    del buffer[:end]
+    return line.decode()
+
+
+def get_from_serv(reader):
+    """one whole reply - lines like 250-... go on, the one with a space after the code is the last"""
+    msg = get_line(reader)
+    while msg.splitlines()[-1][3:4] == "-":
+        msg += get_line(reader)
+    log(msg)  # helper function to save on lines of code
     return msg
 
 
+def extensions(response):
+    """keywords the server listed in its EHLO reply (every line after the greeting one)"""
+    return {line[4:].split()[0].upper() for line in response.splitlines()[1:] if line[4:].split()}
+
+
 def send_RCPT_TO(
-        my_socket,
-        recipient=SMTP_protocol.RCPT,
+        reader,
+        recipient=SMTP_protocol.RECIPIENT,
         domain=SMTP_protocol.DOMAIN):
     """Send SMTP_protocol.RCPT TO message to server"""
-    my_socket.send(create_RCPT_TO(f"{recipient}@{domain}"))  # full email
-    response = get_from_serv(my_socket)
+    reader["socket"].send(create_RCPT_TO(f"{recipient}@{domain}"))  # full email
+    response = get_from_serv(reader)
     return req_comp(response)
 
 
 def send_MAIL_FROM(
-        my_socket,
+        reader,
         sender=SMTP_protocol.USER,
         domain=SMTP_protocol.DOMAIN):
     """Send MAIL FROM message to server"""
-    my_socket.send(create_MAIL_FROM(f"{sender}@{domain}"))  # adds full address
-    response = get_from_serv(my_socket)
+    reader["socket"].send(create_MAIL_FROM(f"{sender}@{domain}"))  # adds full address
+    response = get_from_serv(reader)
     return req_comp(response)
 
 
-def main():
+def send_envelope(
+        reader,
+        sender=SMTP_protocol.USER,
+        recipient=SMTP_protocol.RECIPIENT,
+        domain=SMTP_protocol.DOMAIN):
+    """
+    PIPELINING - send MAIL FROM, RCPT TO and DATA in one write, then match the replies in order
+    one round trip instead of three, returns whether the server is ready for the content
+    """
+    reader["socket"].sendall(
+        create_MAIL_FROM(f"{sender}@{domain}")
+        + create_RCPT_TO(f"{recipient}@{domain}")
+        + create_DATA()
+    )
+    mail_from = req_comp(get_from_serv(reader))
+    rcpt_to = req_comp(get_from_serv(reader))
+    data = get_from_serv(reader).startswith(SMTP_protocol.ENTER_MESSAGE)
+    return mail_from and rcpt_to and data
+
+
+def content_chunks(email):
+    """
+    the email as chunks of bytes - email can be the text itself (str/bytes), a path to a file (pathlib.Path),
+    an open file or any iterable/generator of str/bytes pieces. files are read DATA_SEND_SIZE at a time
+    """
+    n = SMTP_protocol.DATA_SEND_SIZE
+    if isinstance(email, os.PathLike):
+        with open(email, "rb") as file:
+            yield from content_chunks(file)
+    elif isinstance(email, (str, bytes)):
+        email = email.encode() if isinstance(email, str) else email
+        for i in range(0, len(email), n):  # slices, so stuffing a big text doesn't copy all of it at once
+            yield email[i: i + n]
+    elif hasattr(email, "read"):
+        chunk = email.read(n)
+        while chunk:
+            yield chunk.encode() if isinstance(chunk, str) else chunk
+            chunk = email.read(n)
+    else:
+        for chunk in email:
+            yield chunk.encode() if isinstance(chunk, str) else chunk
+
+
+def dot_stuff(chunks):
+    """
+    make the chunks safe to send after DATA - every line ends with CRLF and a line that starts with a dot gets
+    another one (the server takes it off again), so no line of the email is taken for the end mark.
+    works across chunk boundaries, a CR at the end of a chunk waits for the next one to see if its LF follows
+    """
+    line_start = True  # the next byte starts a line
+    carry = b""
+    for chunk in chunks:
+        data = carry + chunk
+        carry = b""
+        if data.endswith(b"\r"):
+            data, carry = data[:-1], b"\r"
+        data = data.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n").replace(b"\r\n.", b"\r\n..")
+        if line_start and data.startswith(b"."):
+            data = b"." + data
+        if data:
+            line_start = data.endswith(b"\r\n")
+            yield data
+    if carry:  # email ended with a lone CR
+        yield b"\r\n"
+
+
+def send_content(my_socket, email):
+    """
+    stream the email content after the server said 354 - read, dot-stuffed and sent DATA_SEND_SIZE at a time
+    so memory stays the same whatever the size. the end mark goes out once, after the last line
+    returns the number of bytes sent, raises ValueError if the email can't be read (the connection is then
+    in the middle of DATA and has to be closed)
+    """
+    out = bytearray()
+    size = 0
+    line_start = True  # empty email so far, or the last chunk ended a line
+    chunks = dot_stuff(content_chunks(email))
+    while True:
+        try:
+            data = next(chunks, None)
+        except OSError as e:  # the file, not the socket - tell them apart for the caller
+            raise ValueError(f"Can't read the email: {e}")
+        if data is None:
+            break
+        out += data
+        line_start = data.endswith(b"\r\n")
+        if len(out) >= SMTP_protocol.DATA_SEND_SIZE:
+            my_socket.sendall(out)
+            size += len(out)
+            out.clear()
+    # end of email - CRLF.CRLF, or only .CRLF if the email already ended its last line
+    out += SMTP_protocol.EMAIL_END[2:].encode() if line_start else SMTP_protocol.EMAIL_END.encode()
+    my_socket.sendall(out)
+    size += len(out)
+    log(f"Email content sent: {size} bytes")
+    return size
+
+
+def reset(reader, msg):
+    """a command of the mail transaction failed - RSET so the next email starts clean"""
+    print(msg)
+    reader["socket"].send(create_RSET())
+    get_from_serv(reader)
+    return False
+
+
+def send_mail(reader, email, pipelining):
+    """one mail transaction on a logged in session, returns whether the server took the email"""
+    my_socket = reader["socket"]
+    if pipelining:
+        # 6-8 mail from, rcpt to and data in one go
+        if send_envelope(
+            reader, SMTP_protocol.USER, SMTP_protocol.RECIPIENT, SMTP_protocol.DOMAIN
+        ):
+            log("MAIL FROM, RCPT TO and DATA commands succeeded (pipelined)")
+        else:
+            return reset(reader, "Error: pipelined MAIL FROM/RCPT TO/DATA failed")
+    else:
+        # 6 mail from
+        if send_MAIL_FROM(
+            reader, SMTP_protocol.USER, SMTP_protocol.DOMAIN
+        ):  # adds full address
+            log("MAIL FROM command succeeded")
+        else:
+            return reset(reader, "Error: MAIL FROM failed")
+
+        # 7 rcpt to
+        if send_RCPT_TO(reader, SMTP_protocol.RECIPIENT, SMTP_protocol.DOMAIN):
+            log("RCT TO command succeeded")
+        else:
+            return reset(reader, "Error: RCPT TO command failed")
+
+        # 8 data
+        my_socket.send(create_DATA())
+        if get_from_serv(reader).startswith(
+            SMTP_protocol.ENTER_MESSAGE
+        ):  # worked! now send content
+            log("DATA command succeeded")
+        else:
+            return reset(reader, "Error: DATA command failed")
+
+    # 9 email content
+    send_content(my_socket, email)
+    response = get_from_serv(reader)  # done with email, the server is ready for the next one either way
+    if req_comp(response):  # now to next stage - succeeded
+        log(f"Client finished sending email contents: {response}")
+        return True
+    elif too_long(response):  # bigger than the server takes
+        print(f"Error: {response}")
+    else:  # failed - didn't get confirmation from server
+        print(f"Error: EMAIL CONTENT command failed {response}")
+    return False
+
+
+def send_batch(reader, emails, pipelining):
+    """
+    push a batch of emails through one logged in session - one connect and AUTH for all of them
+    returns how many the server took
+    """
+    sent = 0
+    for i, email_text in enumerate(emails, 1):
+        log(f"Sending email {i} of {len(emails)}")
+        if send_mail(reader, email_text, pipelining):
+            sent += 1
+    return sent
+
+
+def connect():
+    """connect to the server, retrying with a growing wait - None if it never answered"""
     # try to initiate connection with server, if worked then skip the
-    # following and go to TRY
+    # following and return it
     my_socket = init_session()
     # retry failed connection - works great if you started client first or
     # have >1 client trying to connect
@@ -162,116 +368,216 @@ def main():
         print(
             f"Exiting after {i-1} unsuccessful attempts"
         )  # we are done (including the 1st try before loop)
-        return
-
-    try:
-        # 1 server welcome message
-        # Check that the welcome message is according to the protocol
-        if get_from_serv(my_socket).startswith(
-                SMTP_protocol.SMTP_SERVICE_READY):
-            print("Welcome message is valid")
-        else:
-            quit(my_socket, f"SMTP SERVICE READY command failed")
+    return my_socket
+
+
+def login(reader):
+    """
+    welcome, EHLO and AUTH LOGIN on a new connection
+    returns whether it worked and whether the server does PIPELINING
+    """
+    my_socket = reader["socket"]
+    # 1 server welcome message
+    # Check that the welcome message is according to the protocol
+    response = get_from_serv(reader)
+    if response.startswith(SMTP_protocol.SMTP_SERVICE_READY):
+        log("Welcome message is valid")
+    elif response.startswith(SMTP_protocol.SERVICE_NOT_AVAILABLE):  # server is full, worth trying again later
+        raise ConnectionError(f"Server busy: {response.strip()}")
+    else:
+        print("Error: SMTP SERVICE READY command failed")
+        return False, False
+
+    # 2 EHLO message
+    my_socket.send(create_EHLO())
+    response = get_from_serv(reader)
+    if req_comp(response):
+        log("EHLO Succeeded")
+        pipelining = SMTP_protocol.PIPELINING in extensions(response)
+    else:
+        print("Error: EHLO command failed")
+        return False, False
+
+    # 3 AUTH LOGIN
+    my_socket.send(create_AUTH_LOGIN())
+    if auth_input(get_from_serv(reader)):
+        log("AUTH LOGIN succeeded")
+    else:
+        print("Error: AUTH LOGIN failed")
+        return False, False
+
+    # 4 Username
+    my_socket.send(create_AUTH_VAL(SMTP_protocol.USER))
+    if auth_input(get_from_serv(reader)):  # get username response
+        log("User auth succeeded")
+    else:
+        print("Error: User authentication failed")
+        return False, False
+
+    # 5 password
+    my_socket.send(create_AUTH_VAL(SMTP_protocol.PASSWORD))
+    if get_from_serv(reader).startswith(
+        SMTP_protocol.AUTH_SUCCESS
+    ):  # get password response
+        log("Password auth succeeded")
+    else:
+        print("Error: Password authentication failed")
+        return False, False
+    return True, pipelining
+
+
+def send_QUIT(reader):
+    """10 quit - done connection - make sure to close properly"""
+    reader["socket"].send(create_QUIT())
+    response = get_from_serv(reader)
+    if response.startswith(SMTP_protocol.GOODBYE):
+        log("Success: Server said goodbye to client - finished session")
+    else:
+        print("Error: Server didn't say goodbye to client - not ended correctly")
+
+
+def load_messages(directory):
+    """every file in the directory is one email - paths, each is streamed from disk when it is sent"""
+    for name in sorted(os.listdir(directory)):
+        path = pathlib.Path(directory, name)
+        if path.is_file():
+            yield path
+
+
+def bulk_connection(messages, lock, results):
+    """
+    one connection of the bulk pool - connect and log in once, then take emails off the shared iterator
+    until it runs out. a lost (or refused with 421) connection is made again with the FAILED_ATTEMPTS
+    backoff and the email it was sending is tried again on it (from the start - a generator that was
+    partly sent can't be, pass texts or paths to have those retried)
+    """
+    email_text = None  # taken off the iterator but not sent yet
+    failures = 0  # connections in a row lost before an email got through
+    while True:
+        my_socket = connect()
+        if my_socket is None:  # server is gone, the email in hand is lost
+            if email_text is not None:
+                results.append((0.0, False))
             return
-
-        # 2 EHLO message
-        my_socket.send(create_EHLO())
-        if req_comp(get_from_serv(my_socket)):
-            print("EHLO Succeeded")
-        else:
-            quit(my_socket, f"EHLO command failed")
-            return
-
-        # 3 AUTH LOGIN
-        my_socket.send(create_AUTH_LOGIN())
-        if auth_input(get_from_serv(my_socket)):
-            print("AUTH LOGIN succeeded")
-        else:
-            quit(my_socket, f"AUTH LOGIN failed")
-            return
-
-        # 4 Username
-        my_socket.send(create_AUTH_VAL(SMTP_protocol.USER))
-        if auth_input(get_from_serv(my_socket)):  # get username response
-            print("User auth succeeded")
-        else:
-            quit(my_socket, "User authentication failed")
+        reader = new_reader(my_socket)
+        try:
+            res, pipelining = login(reader)
+            if not res:  # wrong credentials won't get better by retrying
+                if email_text is not None:
+                    results.append((0.0, False))
+                return
+            while True:
+                if email_text is None:
+                    with lock:  # generators can't be shared between threads without one
+                        email_text = next(messages, None)
+                    if email_text is None:  # all sent
+                        send_QUIT(reader)
+                        return
+                source = email_text
+                if isinstance(email_text, os.PathLike):  # open it before the transaction, not in the middle of DATA
+                    try:
+                        source = open(email_text, "rb")
+                    except OSError as e:  # this email is bad, the connection is fine
+                        print(f"Error: can't read {email_text}: {e}")
+                        results.append((0.0, False))
+                        email_text = None
+                        continue
+                start = time.perf_counter()
+                try:
+                    res = send_mail(reader, source, pipelining)
+                finally:
+                    if source is not email_text:
+                        source.close()
+                results.append((time.perf_counter() - start, res))  # list.append is thread safe
+                email_text = None
+                failures = 0
+        except ValueError as e:  # email failed to read half way, the DATA can't be taken back - new connection
+            print(f"Error: {e}")
+            results.append((0.0, False))
+            email_text = None
+        except (ConnectionError, socket.error) as e:  # socket.timeout is a socket.error too
+            print(f"Connection lost: {e}")
+            failures += 1
+        finally:
+            my_socket.close()
+        if failures > SMTP_protocol.FAILED_ATTEMPTS:
+            print(f"Exiting after {failures} lost connections in a row")
+            if email_text is not None:
+                results.append((0.0, False))
             return
+        time.sleep(failures**2)  # same backoff as connecting
+
+
+def percentile(latencies, p):
+    """nearest rank percentile of a sorted list, in milliseconds"""
+    if not latencies:
+        return 0.0
+    rank = max(int(round(p / 100 * len(latencies))) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)] * 1000
+
+
+def bulk_send(messages, connections=SMTP_protocol.BULK_CONNECTIONS):
+    """
+    deliver a directory (path) or any iterable of emails over a pool of parallel logged in connections
+    prints emails/sec and latency per email, returns how many the server took
+    """
+    global VERBOSE
+    VERBOSE = False  # thousands of emails, only errors and the summary are printed
+    if isinstance(messages, str):
+        messages = load_messages(messages)
+    messages = iter(messages)
+    lock = threading.Lock()
+    results = []  # (latency, whether the server took it) for every email
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=bulk_connection, args=(messages, lock, results), daemon=True)
+        for _ in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    sent = sum(1 for row in results if row[1])
+    latencies = sorted(row[0] for row in results if row[1])
+    print(f"Sent {sent} of {len(results)} emails over {connections} connections in {elapsed:.2f} seconds")
+    print(f"{sent / elapsed if elapsed else 0.0:.1f} emails/sec")
+    if latencies:
+        print(
+            f"Latency per email: avg {sum(latencies) / len(latencies) * 1000:.2f} ms, "
+            f"p50 {percentile(latencies, 50):.2f} ms, p95 {percentile(latencies, 95):.2f} ms, "
+            f"p99 {percentile(latencies, 99):.2f} ms, max {latencies[-1] * 1000:.2f} ms"
+        )
+    return sent
 
-        # 5 password
-        my_socket.send(create_AUTH_VAL(SMTP_protocol.PASSWORD))
-        if get_from_serv(my_socket).startswith(
-            SMTP_protocol.AUTH_SUCCESS
-        ):  # get password response
-            print("Password auth succeeded")
-        else:
-            quit(my_socket, "Password authentication failed")
-            return
 
-        # 6 mail from
-        if send_MAIL_FROM(
-            my_socket, SMTP_protocol.USER, SMTP_protocol.DOMAIN
-        ):  # adds full address
-            print("MAIL FROM command succeeded")
-        else:
-            quit(my_socket, "Error: MAIL FROM failed")
-            return
+def main():
+    # bulk mode - client.py <directory of emails> [connections]
+    if len(sys.argv) > 1:
+        connections = int(sys.argv[2]) if len(sys.argv) > 2 else SMTP_protocol.BULK_CONNECTIONS
+        bulk_send(sys.argv[1], connections)
+        return
 
-        # 7 rcpt to
-        if send_RCPT_TO(my_socket, SMTP_protocol.RCPT, SMTP_protocol.DOMAIN):
-            print("RCT TO command succeeded")
-        else:
-            quit(my_socket, "Error: SMTP_protocol.RCPT TO command failed")
-            return
+    my_socket = connect()
+    if my_socket is None:
+        return
 
-        # 8 data
-        my_socket.send(create_DATA())
-        if get_from_serv(my_socket).startswith(
-            SMTP_protocol.ENTER_MESSAGE
-        ):  # worked! now send content
-            print("DATA command succeeded")
-        else:
-            quit(my_socket, "Error: DATA command failed")
+    reader = new_reader(my_socket)
+    try:
+        # 1-5 welcome, EHLO and login
+        res, pipelining = login(reader)
+        if not res:
+            quit(my_socket, "Session setup failed")
             return
 
-        # 9 email content
-        l = len(EMAIL_TEXT)
-        n = SMTP_protocol.MSG_SIZE
-        if l <= n:  # can send it all in 1 packet
-            print("Email content fits in one message! Sending it to server")
-            my_socket.send(create_CONTENT(EMAIL_TEXT))  # 1 message, send it
-        else:  # if exceeds max size, split it into chunks of 1024 bytes
-            print(
-                f"Email content length: {l} exceeds one message, splitting it"
-            )  # (or number set in config file MSG_SIZE)
-            j = 1  # counter for message number
-            for i in range(
-                    0, l, n):  # go through email, in steps of n bytes (1024)
-                print(
-                    f"Sending message {j} with bytes [{i} to {n+i}) to server"
-                )  # document how far through
-                j += 1  # increment
-                my_socket.send(
-                    create_CONTENT(EMAIL_TEXT[i: n + i])
-                )  # splice array to get next parts
-
-        response = get_from_serv(my_socket)  # done with email
-        if req_comp(response):  # now to next stage - succeeded
-            print(f"Client finished sending email contents: {response}")
-        elif too_long(response):  # too many fragmented messages
-            quit(my_socket, f"Error: {response}")
-            return
-        else:  # failed - didn't get confirmation from server
-            quit(my_socket, f"Error: EMAIL CONTENT command failed {response}")
-            return
+        # 6-9 one mail transaction per email, all of them over this one session
+        emails = [EMAIL_TEXT] * SMTP_protocol.EMAILS_PER_SESSION
+        sent = send_batch(reader, emails, pipelining)
+        print(f"Sent {sent} of {len(emails)} emails in one session")
 
-        # 10 quit - done connection - make sure to close properly
-        my_socket.send(create_QUIT())
-        response = get_from_serv(my_socket)
-        if response.startswith(SMTP_protocol.GOODBYE):
-            print("Success: Server said goodbye to client - finished session")
-        else:
-            print("Error: Server didn't say goodbye to client - not ended correctly")
+        # 10 quit
+        send_QUIT(reader)
     except ConnectionResetError as cre:
         print(f"Connection forcibly closed on client {cre}")
     except ConnectionRefusedError as cref:
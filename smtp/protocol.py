@@ -2,7 +2,9 @@
 PORT = 25  # or 587 for encrypted mail (newer addition)
 SMTP_SERVICE_READY = "220"
 REQUESTED_ACTION_COMPLETED = "250"
+COMMAND_UNRECOGNIZED = "500"
 COMMAND_SYNTAX_ERROR = "501"
+BAD_SEQUENCE = "503"  # e.g. DATA before any RCPT TO
 INCORRECT_AUTH = "535"
 ENTER_MESSAGE = "354"
 AUTH_INPUT = "334"
@@ -10,7 +12,10 @@ AUTH_SUCCESS = "235"
 # <CRLF>.<CRLF> ",\n" # Find which combination of chars indicates email end
 EMAIL_END = "\r\n.\r\n"
 GOODBYE = "221"  # quit from server
+SERVICE_NOT_AVAILABLE = "421"  # server is full, try again later
+LOCAL_ERROR = "451"  # email could not be stored, the client may try again
 CLIENT_QUIT = "QUIT\r\n"
+RSET = "RSET\r\n"  # drop the mail transaction in progress, the session goes on
 
 
 # bonus
@@ -20,24 +25,37 @@ MAIL_FROM = "MAIL FROM: "
 DATA = "DATA\r\n"
 EHLO = "EHLO"
 MSG_TOO_LONG = "552"
+PIPELINING = "PIPELINING"  # extension (RFC 2920) - the client may send MAIL FROM, RCPT TO and DATA without waiting
+SIZE = "SIZE"  # extension (RFC 1870) - EHLO advertises the biggest message, MAIL FROM may declare SIZE=n up front
 
 
 # client side
 CLIENT_NAME = "client.net"
 FAILED_ATTEMPTS = 5  # how many times to try to reconnect after a failure
+CLIENT_TIMEOUT = 30  # in seconds, a server that stalls longer than this counts as a lost connection
 CLIENT_IP = "127.0.0.1"  # or localhost
 # email configurations
 USER = "barbie"
-RCPT = "ken"
+RECIPIENT = "ken"  # (was RCPT, which hid the RCPT TO command above)
 DOMAIN = "mattel.com"
 PASSWORD = "helloken"
+EMAILS_PER_SESSION = 3  # emails the client sends over one connection before QUIT
+DATA_SEND_SIZE = 64 * 1024  # in bytes, emails are read and sent this much at a time
+BULK_CONNECTIONS = 8  # parallel logged in connections of the bulk sender (keep under the server's MAX_SESSIONS)
 
 # server side
 SERVER_NAME = "SMTP_server.com"
 SERVER_ADDRESS = "127.0.0.1"
 SOCKET_TIMEOUT = 10  # give it some time to connect - server side
+MAX_SESSIONS = 32  # mail sessions served at once (one thread each), clients past that get a 421
+SPOOL_DIR = "spool"  # emails are written to tmp/ as they arrive, then appended to a segment file in new/ once stored
+SPOOL_INDEX = "index.jsonl"  # in SPOOL_DIR, one json line per stored email (id, sender, recipients, size, segment, offset)
+SEGMENT_SIZE = 64 * 1024 * 1024  # in bytes, a new segment file is started once the current one is this big
+COMMIT_BATCH = 256  # most emails stored together by one group commit
+DATA_RECV_SIZE = 64 * 1024  # in bytes, read size while receiving a message, memory per session stays around this
 
 # not part of protocol but good for client/server to share
-MAX_MESSAGES = 100  # how many fragmented messages are allowed (content)
+MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # in bytes, biggest message accepted (advertised with SIZE)
+MAX_LINE_LENGTH = 1000  # in bytes, longest line (CRLF included) as RFC 5321 allows, longer commands are refused
 
 MSG_SIZE = 1024  # set a magic number for byte size max to accept at each end point
@@ -1,12 +1,26 @@
 import base64
+import itertools
+import json
+import os
+import queue
 import re
+import shutil
 import socket
+import threading
 import time
 
 import SMTP_protocol
 
 user_names = {"shooki": "abcd1234", "barbie": "helloken"}
 
+# free session slots, every client takes one for as long as its session runs
+SESSIONS = threading.BoundedSemaphore(SMTP_protocol.MAX_SESSIONS)
+# received emails waiting for the committer thread to make them durable
+COMMITS = queue.Queue()
+MESSAGE_NUMBERS = itertools.count()  # unique part of the message and segment names
+# files of the committer thread - the segment emails are appended to (and its name) and the index
+SPOOL = {"segment": None, "name": None, "index": None}
+
 
 # helper functions to avoid repetition
 def decode_b64(message):
@@ -33,8 +47,8 @@ def create_initial_response():
     curr_date = str(
         time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.localtime())
     )  # timestamp
-    # 220 SMTP_protocol.SERVER_NAME SMTP service ready
-    return f"{SMTP_protocol.SMTP_SERVICE_READY}-{SMTP_protocol.SERVER_NAME} {curr_date}\r\n SMTP service ready for mail".encode()
+    # 220 SMTP_protocol.SERVER_NAME SMTP service ready - one line, the client reads replies line by line
+    return f"{SMTP_protocol.SMTP_SERVICE_READY} {SMTP_protocol.SERVER_NAME} {curr_date} SMTP service ready for mail\r\n".encode()
 
 
 # Example of how a server function should look like
@@ -42,14 +56,23 @@ def create_EHLO_response(client_message):
     """Check if client message is legal EHLO message
     If yes - returns proper Hello response
     Else - returns proper protocol error code"""
-    if not client_message.startswith(SMTP_protocol.EHLO):
-        return ("{}".format(SMTP_protocol.COMMAND_SYNTAX_ERROR)).encode(), False
+    if not client_message.startswith(SMTP_protocol.EHLO) or len(client_message.split()) < 2:
+        return (
+            "{} EHLO with the client name expected\r\n".format(
+                SMTP_protocol.COMMAND_SYNTAX_ERROR).encode(),
+            False,
+        )
     client_name = client_message.split()[1]
     return (
-        "{}-{} Hello {}\r\n".format(
+        "{}-{} Hello {}\r\n{}-{}\r\n{} {} {}\r\n".format(
             SMTP_protocol.REQUESTED_ACTION_COMPLETED,
             SMTP_protocol.SERVER_NAME,
             client_name,
+            SMTP_protocol.REQUESTED_ACTION_COMPLETED,
+            SMTP_protocol.PIPELINING,
+            SMTP_protocol.REQUESTED_ACTION_COMPLETED,  # last line of the reply, no dash
+            SMTP_protocol.SIZE,
+            SMTP_protocol.MAX_MESSAGE_SIZE,
         ).encode(),
         True,
     )
@@ -61,7 +84,7 @@ def create_AUTH_response(client_message):
     if client_message.startswith(
             SMTP_protocol.AUTH_LOGIN):  # valid client message
         return (
-            "{}-{}\r\n".format(
+            "{} {}\r\n".format(
                 SMTP_protocol.AUTH_INPUT, b64_setup("Username")
             ).encode(),
             True,
@@ -79,7 +102,7 @@ def create_AUTH_response(client_message):
 def create_USER_response(client_message):
     if client_message in user_names.keys():  # go through dictionary
         return (
-            "{}-{}\r\n".format(
+            "{} {}\r\n".format(
                 SMTP_protocol.AUTH_INPUT, b64_setup("Password")
             ).encode(),
             True,
@@ -113,8 +136,30 @@ def create_PASSWORD_response(user: str, passw: str):
         )  # user password mismatch
 
 
+def declared_size(client_message):
+    """SIZE=n parameter of MAIL FROM (0 if the client didn't declare one), None if it is not a number"""
+    for param in client_message.split()[2:]:
+        if param.upper().startswith(SMTP_protocol.SIZE + "="):
+            size = param.split("=", 1)[1]
+            return int(size) if size.isdigit() else None
+    return 0
+
+
 def create_MAIL_FROM_response(client_message):
     if client_message.startswith(SMTP_protocol.MAIL_FROM):  # valid command
+        size = declared_size(client_message)
+        if size is None:
+            return (
+                "{} Bad SIZE parameter\r\n".format(
+                    SMTP_protocol.COMMAND_SYNTAX_ERROR).encode(),
+                False,
+            )
+        if size > SMTP_protocol.MAX_MESSAGE_SIZE:  # refuse before the client sends any of it
+            return (
+                "{} Message size exceeds fixed maximum message size\r\n".format(
+                    SMTP_protocol.MSG_TOO_LONG).encode(),
+                False,
+            )
         return (
             "{} OK\r\n".format(
                 SMTP_protocol.REQUESTED_ACTION_COMPLETED).encode(),
@@ -163,30 +208,51 @@ def create_DATA_response(client_message):
         )
 
 
+def create_RSET_response():
+    return "{} OK\r\n".format(SMTP_protocol.REQUESTED_ACTION_COMPLETED).encode()
+
+
+def create_BAD_SEQUENCE_response(reason):
+    """command that is fine by itself but not at this point of the mail transaction"""
+    return "{} Bad sequence of commands: {}\r\n".format(
+        SMTP_protocol.BAD_SEQUENCE, reason).encode()
+
+
+def create_UNKNOWN_response():
+    return "{} Command not recognized\r\n".format(
+        SMTP_protocol.COMMAND_UNRECOGNIZED).encode()
+
+
+def create_LOCAL_ERROR_response():
+    return "{} Requested action aborted: local error in processing\r\n".format(
+        SMTP_protocol.LOCAL_ERROR).encode()
+
+
 def create_ERROR_RESPONSE():
-    """Error message for too many messages sent by client"""
+    """Error message for a message bigger than MAX_MESSAGE_SIZE"""
     return "{} Message is too long\r\n".format(
         SMTP_protocol.MSG_TOO_LONG).encode()
 
 
-def create_CONTENT_RESPONSE(client_message):
+def create_CONTENT_RESPONSE(size):
     """
-    gets email and checks if ends with SMTP_protocol.EMAIL_END
+    gets the size of the received email (see receive_DATA, the end mark was already found) and checks it is allowed
     """
-    if client_message.endswith(
-            SMTP_protocol.EMAIL_END):  # done sending content
+    if size <= SMTP_protocol.MAX_MESSAGE_SIZE:  # done sending content
         return (
             "{} OK\r\n".format(
                 SMTP_protocol.REQUESTED_ACTION_COMPLETED).encode(),
             True,
         )  # 250 ok per wireshark
     else:
-        return (
-            "{} No end email deliminator found\r\n".format(
-                SMTP_protocol.COMMAND_SYNTAX_ERROR
-            ).encode(),
-            False,
-        )
+        return create_ERROR_RESPONSE(), False
+
+
+def create_BUSY_response():
+    """Sent instead of the greeting when MAX_SESSIONS clients are already being served"""
+    return "{} {} too many sessions, try again later\r\n".format(
+        SMTP_protocol.SERVICE_NOT_AVAILABLE, SMTP_protocol.SERVER_NAME
+    ).encode()
 
 
 def create_QUIT_response(client_message):
@@ -207,25 +273,289 @@ def create_QUIT_response(client_message):
         )
 
 
+def new_reader(client_socket):
+    """buffered reader for one session - a command may come split over several recvs, or with the next ones in one"""
+    return {"socket": client_socket, "buffer": bytearray(), "out": bytearray()}
+
+
+def flush(reader):
+    """send the replies held back so far in one write"""
+    if reader["out"]:
+        reader["socket"].sendall(reader["out"])
+        reader["out"].clear()
+
+
+def send_reply(reader, response):
+    """
+    reply to a command - with PIPELINING the client may have sent a group of commands at once,
+    so replies are held back while more commands are waiting in the buffer and go out together
+    """
+    reader["out"] += response
+    if b"\r\n" not in reader["buffer"]:  # client is waiting for us
+        flush(reader)
+
+
+def fill(reader, size=SMTP_protocol.MSG_SIZE):
+    """read more from the client into the reader's buffer"""
+    flush(reader)  # never wait for the client with replies still held back
+    data = reader["socket"].recv(size)
+    if not data:
+        raise ConnectionError("Client closed the connection")
+    reader["buffer"] += data
+
+
+def get_line(reader):
+    """next line from the client, CRLF included"""
+    buffer = reader["buffer"]
+    end = buffer.find(b"\r\n")
+    while end == -1:
+        if len(buffer) > SMTP_protocol.MAX_LINE_LENGTH:
+            raise ValueError("Line too long")
+        fill(reader)
+        end = buffer.find(b"\r\n", max(len(buffer) - SMTP_protocol.MSG_SIZE - 1, 0))
+    line = bytes(buffer[: end + 2])
+    del buffer[: end + 2]
+    return line.decode()
+
+
 def get_from_client(
-    client_socket, to_print=True
+    reader, to_print=True
 ):  # get message from client, avoid duplicate code
-    msg = client_socket.recv(SMTP_protocol.MSG_SIZE).decode()
+    msg = get_line(reader)
     if to_print:
         print(msg)
     return msg
 
 
+def open_spool():
+    """
+    new file in SPOOL_DIR/tmp for a message that is about to come in
+    returns the open file and the message id (maildir style name - time.pid_number.host), also its file name
+    """
+    message_id = spool_name()
+    path = os.path.join(SMTP_protocol.SPOOL_DIR, "tmp", message_id)
+    return open(path, "xb"), message_id
+
+
+def spool_name():
+    """unique name for a message or a segment - time.pid_number.host, like maildir"""
+    return f"{int(time.time())}.{os.getpid()}_{next(MESSAGE_NUMBERS)}.{SMTP_protocol.SERVER_NAME}"
+
+
+def sync_dir(path):
+    """fsync a directory, makes the files created in it durable"""
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def new_segment():
+    """start a new segment file in new/ (the old one, if any, is complete and stays as it is)"""
+    if SPOOL["segment"] is not None:
+        SPOOL["segment"].close()
+    SPOOL["name"] = spool_name()
+    new_dir = os.path.join(SMTP_protocol.SPOOL_DIR, "new")
+    SPOOL["segment"] = open(os.path.join(new_dir, SPOOL["name"]), "xb")
+    sync_dir(new_dir)  # the segment itself survives a crash, its data is synced with every batch
+
+
+def commit_batch(batch):
+    """
+    make a batch of received emails durable - they are appended one after the other to the current segment
+    file, then one data sync of the segment and one of the index (where every email's segment and offset are)
+    cover the whole batch. only the committer thread calls this
+    """
+    sync_data = getattr(os, "fdatasync", os.fsync)  # no fdatasync on windows
+    stored = []
+    try:
+        if SPOOL["segment"] is None or SPOOL["segment"].tell() >= SMTP_protocol.SEGMENT_SIZE:
+            new_segment()
+        segment = SPOOL["segment"]
+        for message in batch:
+            offset = segment.tell()
+            try:
+                with open(os.path.join(SMTP_protocol.SPOOL_DIR, "tmp", message["id"]), "rb") as source:
+                    shutil.copyfileobj(source, segment, SMTP_protocol.DATA_RECV_SIZE)
+            except OSError as e:  # this email only, take back what got in
+                print(f"Error: could not store email {message['id']}: {e}")
+                segment.seek(offset)
+                segment.truncate()
+                continue
+            message["record"]["segment"] = SPOOL["name"]
+            message["record"]["offset"] = offset
+            stored.append(message)
+        if stored:
+            segment.flush()
+            sync_data(segment.fileno())
+            index = SPOOL["index"]
+            end = index.tell()
+            try:
+                for message in stored:
+                    index.write(json.dumps(message["record"]) + "\n")
+                index.flush()
+                os.fsync(index.fileno())
+            except OSError:
+                index.truncate(end)  # no half written lines
+                raise
+    except OSError as e:
+        print(f"Error: could not commit {len(batch)} emails: {e}")
+        stored = []
+        if SPOOL["segment"] is not None:  # unknown state, the next batch starts a new segment
+            try:
+                SPOOL["segment"].close()
+            except OSError:
+                pass
+            SPOOL["segment"] = None
+    for message in stored:
+        message["ok"] = True
+        try:
+            os.remove(os.path.join(SMTP_protocol.SPOOL_DIR, "tmp", message["id"]))
+        except OSError:
+            pass
+    for message in batch:
+        message["done"].set()  # wake the sessions, they reply 250 or 451
+
+
+def committer():
+    """
+    group commit thread - takes every email that is waiting (up to COMMIT_BATCH) and stores them together,
+    emails that arrive meanwhile wait for the next batch. the busier the server, the more emails share the syncs
+    """
+    while True:
+        batch = [COMMITS.get()]
+        while len(batch) < SMTP_protocol.COMMIT_BATCH:
+            try:
+                batch.append(COMMITS.get_nowait())
+            except queue.Empty:
+                break
+        commit_batch(batch)
+
+
+def start_spool():
+    """make the spool directories, open the index and start the committer"""
+    for name in ("tmp", "new"):
+        os.makedirs(os.path.join(SMTP_protocol.SPOOL_DIR, name), exist_ok=True)
+    SPOOL["index"] = open(os.path.join(SMTP_protocol.SPOOL_DIR, SMTP_protocol.SPOOL_INDEX), "a")
+    sync_dir(SMTP_protocol.SPOOL_DIR)
+    threading.Thread(target=committer, daemon=True).start()
+
+
+def commit_message(message_id, record):
+    """hand a received email to the committer and wait until it is durable, returns whether it was stored"""
+    message = {"id": message_id, "record": record, "ok": False, "done": threading.Event()}
+    COMMITS.put(message)
+    message["done"].wait()
+    return message["ok"]
+
+
+def receive_DATA(reader, spool):
+    """
+    read the email after DATA line by line up to the "." line - the end mark may be split over any number of recvs
+    lines are dot-unstuffed and written to spool as they come, so memory stays at about one recv whatever the size
+    returns the size of the email, bytes past MAX_MESSAGE_SIZE are read (to find the end) but not written
+    """
+    buffer = reader["buffer"]
+    size = 0
+    line_start = True  # the next byte starts a line, only there a dot means something
+    while True:
+        pos = 0
+        lines = []
+        done = False
+        while True:
+            end = buffer.find(b"\r\n", pos)
+            if end == -1:
+                break
+            line = buffer[pos: end + 2]
+            pos = end + 2
+            if line_start:
+                if line == b".\r\n":  # end of the email
+                    done = True
+                    break
+                if line.startswith(b"."):  # the client doubled the dot, so it isn't taken for the end
+                    line = line[1:]
+            line_start = True
+            lines.append(line)
+        if not done and len(buffer) - pos > SMTP_protocol.MAX_LINE_LENGTH:
+            # overlong line, pass on what we have (a CR at the end waits for its LF)
+            end = len(buffer) - 1 if buffer.endswith(b"\r") else len(buffer)
+            line = buffer[pos:end]
+            if line_start and line.startswith(b"."):
+                line = line[1:]
+            lines.append(line)
+            pos = end
+            line_start = False
+        data = b"".join(lines)
+        if size + len(data) <= SMTP_protocol.MAX_MESSAGE_SIZE:
+            spool.write(data)
+        size += len(data)
+        del buffer[:pos]
+        if done:
+            return size
+        fill(reader, SMTP_protocol.DATA_RECV_SIZE)
+
+
+def new_transaction():
+    """state of one mail transaction - MAIL FROM starts it, the end of DATA or RSET clears it"""
+    return {"sender": None, "recipients": []}
+
+
+def address(client_message):
+    """the <address> part of a MAIL FROM / RCPT TO line"""
+    found = re.search(r"<([^>]*)>", client_message)
+    return found.group(1) if found else client_message.split(":", 1)[-1].strip()
+
+
+def receive_message(reader, transaction):
+    """
+    DATA stage of a transaction - spool the email and return the reply for it
+    the whole email is read even when it is refused, so the client can go on with the next one
+    250 only goes out once the email is durable in the spool (see commit_batch)
+    """
+    spool, message_id = open_spool()
+    path = spool.name
+    try:
+        size = receive_DATA(reader, spool)
+    except Exception:  # client went away in the middle, nothing to keep
+        spool.close()
+        os.remove(path)
+        raise
+    spool.close()
+
+    response, res = create_CONTENT_RESPONSE(size)  # check the size limit
+    if not res:
+        print(f"Error: email of {size} bytes exceeds the maximum size allowed by server")
+        os.remove(path)
+        return response
+    record = {
+        "id": message_id,
+        "sender": transaction["sender"],
+        "recipients": transaction["recipients"],
+        "size": size,
+    }  # commit_batch adds the segment and offset
+    if not commit_message(message_id, record):
+        if os.path.exists(path):
+            os.remove(path)
+        return create_LOCAL_ERROR_response()
+    print(
+        f"Email from {transaction['sender']} to {', '.join(transaction['recipients'])} "
+        f"stored: {size} bytes, id {message_id}"
+    )
+    return response
+
+
 def handle_SMTP_client(client_socket):
+    reader = new_reader(client_socket)
     try:
         # 1 send initial message
         message = create_initial_response()
-        client_socket.send(message)
+        send_reply(reader, message)
         print(message.decode())
 
         # 2 receive and send EHLO
-        response, res = create_EHLO_response(get_from_client(client_socket))
-        client_socket.send(response)
+        response, res = create_EHLO_response(get_from_client(reader))
+        send_reply(reader, response)
         if res:
             print("EHLO worked")
         else:
@@ -233,8 +563,8 @@ def handle_SMTP_client(client_socket):
             return
 
         # 3 receive and send AUTH Login
-        response, res = create_AUTH_response(get_from_client(client_socket))
-        client_socket.send(response)
+        response, res = create_AUTH_response(get_from_client(reader))
+        send_reply(reader, response)
         if res:
             print("AUTH LOGIN worked")
         else:
@@ -244,12 +574,12 @@ def handle_SMTP_client(client_socket):
             return
 
         # 4 receive and send USER message
-        decoded_user = decode_b64(get_from_client(client_socket)).split()[
+        decoded_user = decode_b64(get_from_client(reader)).split()[
             0
         ]  # decode user (in 1st arg)
         response, res = create_USER_response(
             decoded_user)  # check if user is valid
-        client_socket.send(response)
+        send_reply(reader, response)
         if res:
             print(f"User entered: {decoded_user}")
         else:
@@ -259,11 +589,11 @@ def handle_SMTP_client(client_socket):
             return
 
         # 5 password
-        decoded_pass = decode_b64(get_from_client(client_socket)).split()[
+        decoded_pass = decode_b64(get_from_client(reader)).split()[
             0
         ]  # decode password (1st arg)
         response, res = create_PASSWORD_response(decoded_user, decoded_pass)
-        client_socket.send(response)
+        send_reply(reader, response)
         if res:
             print(f"User {decoded_user} logged in successfully")
         else:
@@ -272,95 +602,77 @@ def handle_SMTP_client(client_socket):
             )  # print error message
             return
 
-        # 6 mail from
-        response, res = create_MAIL_FROM_response(
-            get_from_client(client_socket))
-        client_socket.send(response)
-        if res:
-            print("MAIL FROM worked")
-        else:
-            print("Error: MAIL FROM failed")
-            return
-
-        # 7 rcpt to
-        response, res = create_RCPT_TO_response(
-            get_from_client(client_socket)
-        )  # (simple case of only 1 recipient)
-        client_socket.send(response)
-        if res:
-            print("RCPT TO worked")
-        else:
-            print("Error: RCPT TO failed")
-            return
-
-        # 8 DATA - preamble to content
-        response, res = create_DATA_response(get_from_client(client_socket))
-        client_socket.send(response)
-        if res:
-            print("DATA command worked")
-        else:
-            print("Error: DATA command failed")
-            return
-
-        # 9 email content
-        # The server should keep receiving data, until the sign of end email is
-        # received
-        proceed = True  # control flag
-        i = 0  # how long to go for
-        # store contents, can come in several fragments/packets if message is
-        # big
-        email_content = []
-        while (
-            proceed and i < SMTP_protocol.MAX_MESSAGES
-        ):  # limit max amount to avoid being overloaded
-            message = get_from_client(client_socket, False)  #
-            if not message:  # runt packet
-                print("Error: Empty packet from client, connection might be closed")
-                proceed = False
-
-            email_content.append(message)  # add to array
-            i += 1  # i++
-            if message.endswith(
-                SMTP_protocol.EMAIL_END
-            ):  # check that last email has the end mark
-                proceed = False  # exit
-
-        # after loop
-        if (
-            i >= SMTP_protocol.MAX_MESSAGES
-        ):  # we want to avoid being overloaded - or sent too many messages,
-            # break away, send error message and close connection
-            print(
-                "Error: exceeded the maximum number of fragmented messages allowed by server"
-            )
-            response = create_ERROR_RESPONSE()
-            client_socket.send(response)
-            return
-
-        print("Email content received:")
-        print("\n".join(email_content))  # combine all to print nicely
-        response, res = create_CONTENT_RESPONSE(
-            email_content[-1]
-        )  # check last message for end mark
-        client_socket.send(response)  # send confirmation
-        if res:
-            print("Client finished email content stage successfully")
-        else:
-            print("Error: Email content failed")
-            return
-
-        # 10 quit
-        message = get_from_client(client_socket)
-        response, res = create_QUIT_response(message)
-        client_socket.send(response)
-        if res:
-            print("Client quit successfully")
-        else:
-            print("Error: client QUIT command failed")
-            return
+        # 6 mail transactions - MAIL FROM, RCPT TO (one or more), DATA and the email content,
+        # as many times as the client wants until it quits. a failed command only fails itself,
+        # RSET throws away the transaction in progress
+        transaction = new_transaction()
+        while True:
+            client_message = get_from_client(reader)
+            command = client_message.upper()
+            if command.startswith(SMTP_protocol.MAIL_FROM.strip()):
+                if transaction["sender"] is not None:
+                    response = create_BAD_SEQUENCE_response("nested MAIL command")
+                else:
+                    response, res = create_MAIL_FROM_response(client_message)
+                    if res:
+                        transaction["sender"] = address(client_message)
+                        print("MAIL FROM worked")
+                send_reply(reader, response)
+
+            elif command.startswith(SMTP_protocol.RCPT):
+                if transaction["sender"] is None:
+                    response = create_BAD_SEQUENCE_response("need MAIL command")
+                else:
+                    response, res = create_RCPT_TO_response(client_message)
+                    if res:
+                        transaction["recipients"].append(address(client_message))
+                        print("RCPT TO worked")
+                send_reply(reader, response)
+
+            elif command.startswith(SMTP_protocol.DATA):
+                if not transaction["recipients"]:  # also what a pipelined DATA gets after its RCPT TO failed
+                    send_reply(reader, create_BAD_SEQUENCE_response("no valid recipients"))
+                    continue
+                response, res = create_DATA_response(client_message)
+                send_reply(reader, response)
+                print("DATA command worked")
+                # The server should keep receiving data, until the sign of end email is
+                # received - straight to a spool file, the email can be any size
+                send_reply(reader, receive_message(reader, transaction))
+                transaction = new_transaction()  # ready for the next email
+
+            elif command.startswith(SMTP_protocol.RSET):
+                transaction = new_transaction()
+                send_reply(reader, create_RSET_response())
+                print("Mail transaction reset")
+
+            elif command.startswith(SMTP_protocol.CLIENT_QUIT):
+                response, res = create_QUIT_response(client_message)
+                send_reply(reader, response)
+                print("Client quit successfully")
+                return
+
+            else:
+                send_reply(reader, create_UNKNOWN_response())
+                print(f"Error: unknown command {client_message.strip()}")
 
     except Exception as e:
         print(f"Generic server error: {e}")
+    finally:
+        try:
+            flush(reader)  # a last reply held back behind a failed command
+        except OSError:
+            pass
+
+
+def serve_session(client_socket, client_address):
+    """Session thread - run the whole mail session, then close the socket and free the slot"""
+    try:
+        handle_SMTP_client(client_socket)
+    finally:
+        client_socket.close()
+        SESSIONS.release()
+        print(f"Client Connection closed: {client_address}")
 
 
 def init_server():
@@ -383,15 +695,26 @@ def init_server():
 def main():
     try:
         server_socket = init_server()  # call init function
+        start_spool()
         while (
             True
         ):  # keep on accepting new users (and loop forever while waiting for clients)
             client_socket, client_address = server_socket.accept()
             print(f"New connection received: {client_address}")
+            if not SESSIONS.acquire(blocking=False):  # full, don't keep the client waiting for a slot
+                print(f"Too many sessions, turning away {client_address}")
+                try:
+                    client_socket.send(create_BUSY_response())
+                except socket.error:
+                    pass
+                client_socket.close()
+                continue
             client_socket.settimeout(
                 SMTP_protocol.SOCKET_TIMEOUT)  # wait for seconds
-            handle_SMTP_client(client_socket)
-            print(f"Client Connection closed: {client_address}")
+            # every session in its own thread, a slow client no longer holds up the others
+            threading.Thread(
+                target=serve_session, args=(client_socket, client_address), daemon=True
+            ).start()
     # handle error cases & fail gracefully below
     except ConnectionResetError as cre:
         print(f"Connection forcibly closed on server {cre}")